@@ -14,6 +14,11 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_store import load_planes
+from Legendre import piecewise_engine
+from Legendre.fitness_cache import FitnessCache
+from Legendre.incremental_fitness import IncrementalFitness
+from Legendre.ga_operators import reproduce
 
 sns.set_theme(style="whitegrid")
 
@@ -68,59 +73,25 @@ def Der(x, w, b, out_w, der_type):
     return out
 
 def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, population, soft=False):
-    sy = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(sig_m, sig_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, sm)
-        cavexx = torch.matmul(x, cvm)
-        sy.append(smx + sc)
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    cavexy = torch.stack(cavexy)
     if soft:
-        soft_y = []
-        for level in soft_levels:
-            exp_cavex = torch.exp(cavexy / level)
-            softness = exp_cavex / torch.sum(exp_cavex, dim=0)
-            print(level, torch.min(softness), torch.max(softness))
-            soft_y.append(torch.sum(sy * softness, dim=0))
-        return soft_y
+        # every soft level in one chunked pass, an online softmax so small levels cannot overflow
+        return list(piecewise_engine.soft_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft_levels,
+                                                          memory_budget=soft_budget))
     else:
-        all_y = []
-        for agent in population:
-            max_vex_max = torch.max(cavexy[agent.cpu().numpy()], dim=0)[1]
-            # min_cave_min = torch.min(-cavexy, dim=0)[1]
-            vex_sy = torch.stack([torch.stack(
-                [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(agent[max_vex_max])])
-            # cave_sy = torch.stack([torch.stack(
-            #     [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min)])
-            # y = (vex_sy + cave_sy) / 2
-            all_y.append(vex_sy)
-        return all_y
+        sy, cavexy = piecewise_engine.plane_responses(x, sig_m, sig_c, cavex_m, cavex_c)
+        # [P, B, out], every agent's winning plane from one gather/max per chunk of agents
+        return piecewise_engine.population_value(sy, cavexy, population, memory_budget=population_budget)
 
 def iterate_population(population, fitnesses):
-    fitnesses = torch.tensor(fitnesses)
-    # population = torch.stack(population)
-    topk = torch.topk(fitnesses, int(elitism*population_size))
-    elite = population[topk[1]]
-    children = []
-    for c in range(int((1-elitism)*population_size)):
-        tournament = np.random.choice(population_size, tournament_size)
-        winner = torch.max(fitnesses[tournament], dim=0)[1]
-        mutate_indexes = np.array([(np.random.random() < mutation_rate) for i in range(genome_length)])
-        child = population[tournament[winner]]
-        new_genes = []
-        for gene in np.where(mutate_indexes == 1)[0]:
-            new_gene = np.random.choice(60000)
-            while new_gene in child or new_gene in new_genes:
-                new_gene = np.random.choice(60000)
-            new_genes.append(new_gene)
-        for gene, new_gene in zip(np.where(mutate_indexes == 1)[0], new_genes):
-            child[gene] = new_gene
-        children.append(child)
-    new_population = torch.vstack([elite, torch.stack(children)])
+    topk = torch.topk(torch.tensor(fitnesses), int(elitism*population_size))
+    elite_index = topk[1].cpu().numpy()
+    elite = population[elite_index]
+    # tournaments, mutation masks and replacement genes for every child at once
+    children, parents = reproduce(population, fitnesses, int((1-elitism)*population_size),
+                                  tournament_size, mutation_rate, len(full_sig_c))
+    new_population = torch.vstack([elite, children])
     # [torch.bincount(population.data[i])[torch.bincount(population.data[i]).nonzero()] for i in range(len(population))]
-    return new_population
+    return new_population, np.concatenate([elite_index, parents])
 
 # full_sig = []
 # full_cavex = []
@@ -178,12 +149,18 @@ def iterate_population(population, fitnesses):
 # torch.save(full_sig_der, 'data/sig_der {}.pt'.format(net_file))
 # torch.save(full_cavex_der, 'data/cavex_der {}.pt'.format(net_file))
 
-full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-full_cavex_c = torch.load('data/cavex_c {}.pt'.format(net_file))
-full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-full_cavex_der = torch.load('data/cavex_der {}.pt'.format(net_file))
+plane_set = ''  # ' pruned' or ' greedy' for the compact plane sets from plane_pruning.py or greedy_selection.py
+planes = load_planes(net_file + plane_set, device=device)
+full_sig_c = planes['sig_c']
+full_cavex_c = planes['cavex_c']
+full_sig_der = planes['sig_der']
+full_cavex_der = planes['cavex_der']
+# every batch uses the full plane set so it is read into memory once
+full_sig_c, full_cavex_c, full_sig_der, full_cavex_der = [
+    p[:] for p in [full_sig_c, full_cavex_c, full_sig_der, full_cavex_der]]
 
 soft_levels = [3, 2, 1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1]
+soft_budget = 2 ** 30  # bytes of plane responses and softmax weights per chunk of planes
 
 generations = 100
 population_size = 100
@@ -192,6 +169,15 @@ batch_n = 100
 tournament_size = 4
 mutation_rate = 0.03
 elitism = 0.1
+population_budget = 2 ** 30  # bytes of gathered cavex responses per chunk of agents
+fixed_eval_set = True  # False draws new test batches every generation, which the cache can never hit
+eval_seed = 272727
+fitness_cache = FitnessCache(max_size=10000)
+incremental = False  # score children from their parent's top two planes, always on the fixed eval set
+if genome_length > len(full_sig_c):
+    # a pruned or greedy plane set can be smaller than a genome, with no planes left out nothing can mutate
+    print("plane set only has {} planes, genome length cut from {}".format(len(full_sig_c), genome_length))
+    genome_length = len(full_sig_c)
 
 test_label = 'g{} p{}x{} t{} m{} e{}'.format(
     generations,
@@ -202,7 +188,7 @@ test_label = 'g{} p{}x{} t{} m{} e{}'.format(
     elitism
 )
 
-population = torch.stack([torch.tensor(np.random.choice(range(60000), genome_length, replace=False)) for i in range(population_size)])
+population = torch.stack([torch.tensor(np.random.choice(range(len(full_sig_c)), genome_length, replace=False)) for i in range(population_size)])
 
 # with torch.no_grad():
 #     correct_m = 0
@@ -226,51 +212,81 @@ population = torch.stack([torch.tensor(np.random.choice(range(60000), genome_len
 #     training_accuracies = [100 * np.array(correct_m) / total, 100 * np.array(correct_l) / total]
 
 with torch.no_grad():
-    generation_metrics = []
-    for g in range(generations):
-        # correct_m = 0
-        correct_l = [0 for i in range(population_size)]
-        total = 0
-        for batch, (images, labels) in enumerate(tqdm(test_loader)):
+    if incremental:
+        # the fixed evaluation set, read once, and every agent's top two planes on it
+        test_loader.generator.manual_seed(eval_seed)
+        eval_batches = []
+        for batch, (images, labels) in enumerate(test_loader):
             if batch >= batch_n:
                 break
+            eval_batches.append((images.reshape(-1, 784).to(torch.device(device)) - 0.5, labels))
+        incremental_fitness = IncrementalFitness(eval_batches, full_sig_der, full_sig_c, full_cavex_der, full_cavex_c)
+        agent_states = [incremental_fitness.full_state(agent) for agent in population]
+
+    generation_metrics = []
+    for g in range(generations):
+        if incremental:
+            testing_accuracies = np.array([incremental_fitness.fitness(state) for state in agent_states])
+            print("Planes evaluated {}   full batch fallbacks {}".format(
+                incremental_fitness.planes_evaluated, incremental_fitness.fallbacks))
+        else:
+            if fixed_eval_set:
+                # the same batch_n test batches every generation so cached fitnesses stay comparable
+                test_loader.generator.manual_seed(eval_seed)
+                eval_id = 'seed{} batches{}'.format(eval_seed, batch_n)
+            else:
+                eval_id = 'generation{}'.format(g)
+            keys, testing_accuracies, to_evaluate = fitness_cache.lookup(population, eval_id)
+            print("Evaluating {} of {} agents, {} cached".format(
+                len(to_evaluate), population_size, population_size - len(to_evaluate)))
+            # correct_m = 0
+            correct_l = np.zeros(len(to_evaluate), dtype=int)
+            total = 0
+            for batch, (images, labels) in enumerate(tqdm(test_loader)):
+                if batch >= batch_n or not len(to_evaluate):
+                    break
 
-            images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
-            # out_m = model(images)
-            # _, pred = torch.max(out_m, 1)
-            # correct_m += (pred == labels).sum().item()
+                images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
+                # out_m = model(images)
+                # _, pred = torch.max(out_m, 1)
+                # correct_m += (pred == labels).sum().item()
 
-            out_l = piecewise_value(images, full_sig_der, full_sig_c, full_cavex_der, full_cavex_c, population)
+                out_l = piecewise_value(images, full_sig_der, full_sig_c, full_cavex_der, full_cavex_c,
+                                        population[to_evaluate])
 
-            for i, out in enumerate(out_l):
-                _, pred = torch.max(out, 1)
-                correct_l[i] += (pred == labels).sum().item()
+                _, pred = torch.max(out_l, 2)
+                correct_l += (pred == labels).sum(dim=1).cpu().numpy()
 
-            total += labels.size(0)
-            if g:
-                print("\nGeneration max, min, mean")
-                for j, g_met in enumerate(generation_metrics):
-                    print(j, g_met)
-            print("Current total", total)
-            # print('Model testing accuracy: {} %'.format(100 * correct_m / total))
-            print('Legendre population testing')
-            print("Max = {}   min = {}   average = {}".format(
-                np.max(100 * np.array(correct_l) / total),
-                np.min(100 * np.array(correct_l) / total),
-                np.mean(100 * np.array(correct_l) / total),
-            ))
-        testing_accuracies = 100 * np.array(correct_l) / total#[100 * np.array(correct_m) / total, 100 * np.array(correct_l) / total]
+                total += labels.size(0)
+                if g:
+                    print("\nGeneration max, min, mean")
+                    for j, g_met in enumerate(generation_metrics):
+                        print(j, g_met)
+                print("Current total", total)
+                # print('Model testing accuracy: {} %'.format(100 * correct_m / total))
+                print('Legendre population testing')
+                print("Max = {}   min = {}   average = {}".format(
+                    np.max(100 * np.array(correct_l) / total),
+                    np.min(100 * np.array(correct_l) / total),
+                    np.mean(100 * np.array(correct_l) / total),
+                ))
+            testing_accuracies = fitness_cache.update(keys, testing_accuracies, to_evaluate,
+                                                      100 * np.array(correct_l) / max(total, 1))
 
         # print("Training accuracies:", training_accuracies)
         print("Testing accuracies:", testing_accuracies)
 
         generation_metrics.append([
-            np.max(100 * np.array(correct_l) / total),
-            np.min(100 * np.array(correct_l) / total),
-            np.mean(100 * np.array(correct_l) / total)
+            np.max(testing_accuracies),
+            np.min(testing_accuracies),
+            np.mean(testing_accuracies)
         ])
 
-        population = iterate_population(population, 100 * np.array(correct_l) / total)
+        parent_population = population
+        population, parents = iterate_population(population, testing_accuracies)
+        if incremental:
+            agent_states = [incremental_fitness.child_state(agent_states[parent], parent_population[parent], child)
+                            for parent, child in zip(parents, population)]
 
         plt.figure()
         x = [i for i in range(len(generation_metrics))]
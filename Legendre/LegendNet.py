@@ -14,6 +14,8 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_extraction import extract_sig_planes
+from Legendre.plane_store import ResumableExtraction, store_path
 sns.set_theme(style="whitegrid")
 
 gpu = True
@@ -86,69 +88,28 @@ def piecewise_value(x, legendre_m, legendre_c, vex=True, soft=False):
 
 
 legendre_scale_factor = 1#0e3
-full_vex_legendre_m = []
-full_cave_legendre_m = []
-full_vex_legendre_c = []
-full_cave_legendre_c = []
 
 hidden_size = model.layer[0].bias.shape[0]
-# net_values = [[] for i in range(hidden_size)]
-# net_total = []
-# vex_values = [[] for i in range(hidden_size)]
-vex_total = []
-# cave_values = [[] for i in range(hidden_size)]
-cave_total = []
+check_extraction = False
+
+# the planes go to a plane store checkpointed every checkpoint_every batches, rerunning after
+# a crash carries on from the last checkpoint and a finished store is reused as is
+checkpoint_every = 50
+extraction = ResumableExtraction(store_path(net_file, suffix=' legendnet'), train_loader,
+                                 checkpoint_every=checkpoint_every, device=device)
 
 print("extracting Legendre transform")
-for images, labels in tqdm(train_loader):
+for images, labels in tqdm(extraction.batches(), initial=extraction.done, total=len(train_loader)):
     images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
-    for i, (w, b, out_w) in enumerate(zip(model.layer[0].weight.data,
-                                   model.layer[0].bias.data,
-                                   torch.transpose(model.layer[1].weight.data, 0, 1)
-                                   )):
-
-        # net_values[i].append(Sig(images, w, b, out_w))
-        # vex_values[i].append(CaVexSig(images, w, b, out_w, True))
-        # cave_values[i].append(CaVexSig(images, w, b, out_w, False))
-        neuron_vex_total = CaVexSig(images, w, b, out_w, True)
-        neuron_cave_total = CaVexSig(images, w, b, out_w, False)
-        neuron_vex_legendre_m = CaVexDer(images, w, b, out_w, True)
-        neuron_cave_legendre_m = CaVexDer(images, w, b, out_w, False)
-
-        for output, ow in enumerate(out_w):
-            if ow < 0:
-                temp = neuron_vex_legendre_m[:, :, output].clone().detach()
-                neuron_vex_legendre_m[:, :, output] = neuron_cave_legendre_m[:, :, output]
-                neuron_cave_legendre_m[:, :, output] = temp
-                temp = neuron_cave_total[:, output].clone().detach()
-                neuron_cave_total[:, output] = neuron_vex_total[:, output]
-                neuron_vex_total[:, output] = temp
-
-        if not i:
-            # net_total.append(net_values[i][-1])
-            full_vex_legendre_m.append(neuron_vex_legendre_m)
-            vex_total.append(neuron_vex_total)
-            full_cave_legendre_m.append(neuron_cave_legendre_m)
-            cave_total.append(neuron_cave_total)
-        else:
-            # net_total[-1] += net_values[i][-1]
-            full_vex_legendre_m[-1] += neuron_vex_legendre_m
-            vex_total[-1] += neuron_vex_total
-            full_cave_legendre_m[-1] += neuron_cave_legendre_m
-            cave_total[-1] += neuron_cave_total
-
-    # real_net = model(images)
-
-    full_vex_legendre_c.append(vex_total[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(full_vex_legendre_m[-1], images)]))
-    full_cave_legendre_c.append(cave_total[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(full_cave_legendre_m[-1], images)]))
+    sig_der, sig_c, cavex_der, cavex_c = extract_sig_planes(images, model, check=check_extraction)
+    extraction.append(sig_der=sig_der, sig_c=sig_c, cavex_der=cavex_der, cavex_c=cavex_c)
+store = extraction.finish()
 
 torch.cuda.empty_cache()
-full_vex_legendre_m = torch.vstack(full_vex_legendre_m)
-full_vex_legendre_c = torch.vstack(full_vex_legendre_c)
-full_cave_legendre_m = torch.vstack(full_cave_legendre_m)
-full_cave_legendre_c = torch.vstack(full_cave_legendre_c)
+full_vex_legendre_m = store['sig_der'][:] + store['cavex_der'][:]
+full_vex_legendre_c = store['sig_c'][:] + store['cavex_c'][:]
+full_cave_legendre_m = store['sig_der'][:] - store['cavex_der'][:]
+full_cave_legendre_c = store['sig_c'][:] - store['cavex_c'][:]
 
 torch.save(full_vex_legendre_m, 'vex_m {}.pt'.format(net_file))
 torch.save(full_vex_legendre_c, 'vex_c {}.pt'.format(net_file))
@@ -0,0 +1,184 @@
+import time
+import numpy as np
+import torch
+
+
+# The winning quadratic cavex plane c_k * x_i . x - 0.5 * c_k * |x_i|^2 for a query x is the
+# anchor x_i with the largest x . x_i - 0.5 * |x_i|^2, which is the anchor nearest to x as
+# long as c_k > 0 (calculate_c always adds a margin so it is). The same anchor wins for every
+# output, so winner selection is a nearest neighbour search over the anchors.
+# Every index has search(x) -> [B] anchor indices.
+
+def anchor_scores(x, anchors, anchor_norms):
+    # x . x_i - 0.5 * |x_i|^2, larger is nearer
+    return torch.matmul(x, torch.transpose(anchors, 0, 1)) - 0.5 * anchor_norms
+
+
+class BruteForceIndex:
+    def __init__(self, anchors, chunk=8192):
+        self.anchors = anchors
+        self.anchor_norms = torch.sum(anchors * anchors, dim=1)
+        self.chunk = chunk
+
+    def search(self, x):
+        best_score = None
+        for start in range(0, len(self.anchors), self.chunk):
+            scores = anchor_scores(x, self.anchors[start:start + self.chunk],
+                                   self.anchor_norms[start:start + self.chunk])
+            chunk_score, chunk_index = torch.max(scores, dim=1)
+            if best_score is None:
+                best_score, best_index = chunk_score, chunk_index
+                continue
+            better = chunk_score > best_score
+            best_score = torch.where(better, chunk_score, best_score)
+            best_index = torch.where(better, chunk_index + start, best_index)
+        return best_index
+
+
+def kmeans(anchors, num_lists, iterations=10, seed=272727, chunk=8192):
+    generator = torch.Generator(device=anchors.device)
+    generator.manual_seed(seed)
+    start_index = torch.randperm(len(anchors), generator=generator, device=anchors.device)[:num_lists]
+    centers = anchors[start_index].clone()
+    for i in range(iterations + 1):
+        center_norms = torch.sum(centers * centers, dim=1)
+        assignment = torch.hstack([
+            torch.max(anchor_scores(anchors[start:start + chunk], centers, center_norms), dim=1)[1]
+            for start in range(0, len(anchors), chunk)])
+        if i == iterations:
+            break
+        counts = torch.bincount(assignment, minlength=len(centers)).to(anchors.dtype)
+        sums = torch.zeros_like(centers).index_add_(0, assignment, anchors)
+        # empty lists keep their old center
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled].unsqueeze(1)
+    return centers, assignment
+
+
+# Anchors split into k-means lists, each list is a ball with a center and a radius. Searching
+# a list only compares the queries that probe it against that list's members.
+class PartitionIndex:
+    def __init__(self, anchors, num_lists=256, iterations=10, seed=272727):
+        self.anchors = anchors
+        self.anchor_norms = torch.sum(anchors * anchors, dim=1)
+        num_lists = min(num_lists, len(anchors))
+        self.centers, assignment = kmeans(anchors, num_lists, iterations, seed)
+        self.center_norms = torch.sum(self.centers * self.centers, dim=1)
+        order = torch.argsort(assignment)
+        counts = torch.bincount(assignment, minlength=num_lists).tolist()
+        self.members = list(torch.split(order, counts))
+        distances = torch.sqrt(torch.sum(torch.square(anchors - self.centers[assignment]), dim=1))
+        self.radii = torch.zeros(num_lists, dtype=anchors.dtype, device=anchors.device).scatter_reduce_(
+            0, assignment, distances, 'amax')
+
+    def center_scores(self, x):
+        return anchor_scores(x, self.centers, self.center_norms)
+
+    def search_lists(self, x, probe, best_score, best_index):
+        # probe is a [B, lists] mask of which lists every query still has to look at
+        for l, members in enumerate(self.members):
+            queries = torch.nonzero(probe[:, l]).squeeze(1)
+            if len(queries) == 0 or len(members) == 0:
+                continue
+            scores = anchor_scores(x[queries], self.anchors[members], self.anchor_norms[members])
+            list_score, list_index = torch.max(scores, dim=1)
+            better = list_score > best_score[queries]
+            best_score[queries] = torch.where(better, list_score, best_score[queries])
+            best_index[queries] = torch.where(better, members[list_index], best_index[queries])
+        return best_score, best_index
+
+    def probe_nearest(self, x, center_scores, num_probes):
+        nearest = torch.topk(center_scores, min(num_probes, len(self.centers)), dim=1)[1]
+        probe = torch.zeros_like(center_scores, dtype=torch.bool).scatter_(1, nearest, True)
+        best_score = torch.full((len(x),), -float('inf'), dtype=x.dtype, device=x.device)
+        best_index = torch.zeros(len(x), dtype=torch.long, device=x.device)
+        best_score, best_index = self.search_lists(x, probe, best_score, best_index)
+        return probe, best_score, best_index
+
+
+# Approximate, only the num_probes lists with the nearest centers are searched
+class IVFIndex(PartitionIndex):
+    def __init__(self, anchors, num_lists=256, num_probes=8, iterations=10, seed=272727):
+        super().__init__(anchors, num_lists, iterations, seed)
+        self.num_probes = num_probes
+
+    def search(self, x):
+        return self.probe_nearest(x, self.center_scores(x), self.num_probes)[2]
+
+
+# Exact, a one level ball tree. The nearest list gives a first winner, then only the balls
+# whose nearest possible point |x - center| - radius could still beat it are searched.
+class BallIndex(PartitionIndex):
+    def search(self, x):
+        center_scores = self.center_scores(x)
+        searched, best_score, best_index = self.probe_nearest(x, center_scores, 1)
+        x_norms = torch.sum(x * x, dim=1).unsqueeze(1)
+        center_distance = torch.sqrt(torch.clamp(x_norms - 2 * center_scores, min=0))
+        lower = torch.clamp(center_distance - self.radii, min=0)
+        # largest score any member of the ball could have
+        bound = 0.5 * (x_norms - torch.square(lower))
+        probe = (bound >= best_score.unsqueeze(1)) & ~searched
+        return self.search_lists(x, probe, best_score, best_index)[1]
+
+
+index_backends = {'brute': BruteForceIndex,
+                  'ball': BallIndex,
+                  'ivf': IVFIndex}
+
+
+def build_index(anchors, backend='brute', **kwargs):
+    if backend not in index_backends:
+        raise ValueError("unknown anchor index {}, choose from {}".format(backend, list(index_backends)))
+    return index_backends[backend](anchors, **kwargs)
+
+
+def benchmark_index(index, x, exact=None, repeats=5, labels=None, classify=None):
+    # agreement with the brute force winners and the speedup over it. Given labels and classify,
+    # which maps [B] winners to [B, out] outputs, also the accuracy lost against the exact winners
+    if exact is None:
+        exact = BruteForceIndex(index.anchors)
+    with torch.no_grad():
+        exact_winners = exact.search(x)
+        winners = index.search(x)
+        index_times = []
+        exact_times = []
+        for r in range(repeats):
+            start = time.perf_counter()
+            index.search(x)
+            index_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            exact.search(x)
+            exact_times.append(time.perf_counter() - start)
+    result = {'index': type(index).__name__,
+              'anchors': len(index.anchors),
+              'queries': len(x),
+              'index_time': float(np.median(index_times)),
+              'exact_time': float(np.median(exact_times)),
+              'speedup': float(np.median(exact_times) / np.median(index_times)),
+              'recall': (winners == exact_winners).to(torch.float32).mean().item()}
+    if classify is not None and labels is not None:
+        with torch.no_grad():
+            exact_accuracy = 100 * (torch.max(classify(exact_winners), 1)[1] == labels).to(torch.float32).mean().item()
+            index_accuracy = 100 * (torch.max(classify(winners), 1)[1] == labels).to(torch.float32).mean().item()
+        result['exact_accuracy'] = exact_accuracy
+        result['index_accuracy'] = index_accuracy
+        result['accuracy_loss'] = exact_accuracy - index_accuracy
+    return result
+
+
+if __name__ == '__main__':
+    torch.manual_seed(272727)
+    # clustered anchors, roughly what images of 10 classes look like
+    class_centers = torch.rand(10, 784) - 0.5
+    anchor_classes = torch.randint(10, (20000,))
+    anchors = class_centers[anchor_classes] + 0.1 * torch.randn(20000, 784)
+    labels = torch.randint(10, (512,))
+    x = class_centers[labels] + 0.1 * torch.randn(512, 784)
+    # every anchor's plane votes for its own class
+    anchor_outputs = torch.nn.functional.one_hot(anchor_classes, 10).to(torch.float32)
+    exact = BruteForceIndex(anchors)
+    print(benchmark_index(BallIndex(anchors, num_lists=64), x, exact, labels=labels,
+                          classify=lambda winners: anchor_outputs[winners]))
+    for num_probes in [1, 4, 16]:
+        print(benchmark_index(IVFIndex(anchors, num_lists=256, num_probes=num_probes), x, exact, labels=labels,
+                              classify=lambda winners: anchor_outputs[winners]))
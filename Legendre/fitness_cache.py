@@ -0,0 +1,54 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+# LRU cache of GA fitnesses. An agent is keyed by the sorted set of its plane indices, so
+# reordered copies of the same genome share an entry, together with the id of the set of
+# batches it was scored on, so fitnesses from different evaluation sets never mix.
+class FitnessCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(genome, eval_id):
+        genome = np.sort(np.asarray(genome, dtype=np.int64))
+        return '{} {}'.format(hashlib.sha1(genome.tobytes()).hexdigest(), eval_id)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, fitness):
+        self.entries[key] = fitness
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def lookup(self, population, eval_id):
+        # keys of every agent, their cached fitnesses (nan when missing) and the agents to
+        # evaluate, only the first of any duplicate genomes is evaluated
+        genomes = population.cpu().numpy()
+        keys = [self.key(genome, eval_id) for genome in genomes]
+        fitnesses = np.array([np.nan if f is None else f for f in [self.get(k) for k in keys]])
+        first = {}
+        for agent in np.where(np.isnan(fitnesses))[0]:
+            first.setdefault(keys[agent], agent)
+        return keys, fitnesses, np.array(sorted(first.values()), dtype=int)
+
+    def update(self, keys, fitnesses, evaluated, scores):
+        # caches the new scores and fills them in for every agent sharing the genome
+        new = {keys[agent]: score for agent, score in zip(evaluated, scores)}
+        for key, score in new.items():
+            self.put(key, score)
+        return np.array([new.get(key, fitness) for key, fitness in zip(keys, fitnesses)])
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,47 @@
+import numpy as np
+import torch
+
+
+# Reproduction for the LeGAendre.py GA, done for all children at once. Same distribution as
+# the per child loop it replaced: tournaments drawn with replacement and won by the first best
+# fitness, every gene mutated with probability mutation_rate, and the new genes drawn uniformly
+# without replacement from the planes the child does not already hold. A child never gets more
+# mutations than there are such planes, so genomes never hold a plane twice.
+
+def tournament_select(fitnesses, num_children, tournament_size, rng=np.random):
+    tournaments = rng.choice(len(fitnesses), (num_children, tournament_size))
+    return tournaments[np.arange(num_children), np.argmax(fitnesses[tournaments], axis=1)]
+
+
+def sample_new_genes(children, counts, num_planes, rng=np.random):
+    # random keys for every plane with the child's own genes pushed to the back (a bitmap of the
+    # genome), the counts[i] smallest keys of row i are a uniform sample from the rest
+    most = int(np.max(counts))
+    if most > num_planes - children.shape[1]:
+        raise ValueError("{} new genes asked for but a genome of {} leaves only {} free planes".format(
+            most, children.shape[1], num_planes - children.shape[1]))
+    keys = rng.random((len(children), num_planes))
+    np.put_along_axis(keys, children, np.inf, axis=1)
+    smallest = np.argpartition(keys, most - 1, axis=1)[:, :most]
+    order = np.argsort(np.take_along_axis(keys, smallest, axis=1), axis=1)
+    return np.take_along_axis(smallest, order, axis=1)
+
+
+def reproduce(population, fitnesses, num_children, tournament_size, mutation_rate, num_planes, rng=np.random):
+    # children [num_children, genome_length] and the index of each child's parent
+    genomes = population.cpu().numpy()
+    parents = tournament_select(np.asarray(fitnesses), num_children, tournament_size, rng)
+    children = genomes[parents].copy()
+    mutate = rng.random(children.shape) < mutation_rate
+    free = num_planes - children.shape[1]
+    if np.any(np.sum(mutate, axis=1) > free):
+        # only free new genes exist for a child, the extra mutations are dropped at random
+        keys = np.where(mutate, rng.random(children.shape), np.inf)
+        mutate &= np.argsort(np.argsort(keys, axis=1), axis=1) < free
+    counts = np.sum(mutate, axis=1)
+    if np.any(counts):
+        new_genes = sample_new_genes(children, counts, num_planes, rng)
+        rows, columns = np.nonzero(mutate)
+        rank = (np.cumsum(mutate, axis=1) - 1)[rows, columns]
+        children[rows, columns] = new_genes[rows, rank]
+    return torch.as_tensor(children, device=population.device), parents
@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+from Legendre import piecewise_engine
+from Legendre.plane_store import store_path, load_planes
+from Legendre.plane_pruning import cavex_winners, plane_names, write_planes
+
+
+# Greedy plane selection on a working set of inputs. Each step takes the sample and output with
+# the worst |model(x) - piecewise_value(x)| and adds the plane that wins there in the full set,
+# the plane whose anchor is tangent nearest to that input. Only that one plane is evaluated
+# over the working set: where its cavex response beats the running max it becomes the mindex
+# output. A sample whose full set winner is already selected cannot be fixed and is skipped.
+
+def greedy_planes(x, target, planes, num_planes, winners=None, labels=None, memory_budget=2 ** 28):
+    # x [N, in] working set, target [N, out] the model outputs on it. Returns the selected plane
+    # indices in the order they were added and, if labels are given, the working set accuracy
+    # after every step.
+    if winners is None:
+        winners = cavex_winners([(x, None)], planes['cavex_der'], planes['cavex_c'], memory_budget)
+    winners = winners.flatten()
+    best_cavex = torch.full(target.shape, -float('inf'), dtype=x.dtype, device=x.device)
+    y = torch.zeros_like(target)
+    done = torch.zeros(target.numel(), dtype=torch.bool, device=x.device)
+    selected = []
+    chosen = set()
+    curve = []
+    while len(selected) < num_planes:
+        error = torch.abs(target - y).flatten()
+        error[done] = -1
+        worst = int(torch.argmax(error))
+        if error[worst] < 0:
+            break
+        plane = int(winners[worst])
+        if plane in chosen:
+            done[worst] = True
+            continue
+        sy, cavexy = piecewise_engine.plane_responses(
+            x, *[planes[name][plane:plane + 1] for name in plane_names])
+        better = cavexy[0] > best_cavex
+        best_cavex = torch.where(better, cavexy[0], best_cavex)
+        y = torch.where(better, sy[0], y)
+        selected.append(plane)
+        chosen.add(plane)
+        if labels is not None:
+            curve.append(100 * (torch.max(y, 1)[1] == labels).to(torch.float32).mean().item())
+    return np.array(selected), curve
+
+
+def selection_curve(batches, planes, selected, sizes=50, memory_budget=2 ** 28):
+    # accuracy in % of the first n selected planes for n spread geometrically up to all of them
+    prefix_sizes = np.unique(np.geomspace(1, len(selected), sizes).astype(int))
+    total = sum([len(labels) for x, labels in batches])
+    correct = piecewise_engine.prefix_correct(batches, planes['sig_der'], planes['sig_c'], planes['cavex_der'],
+                                              planes['cavex_c'], selected, prefix_sizes, memory_budget)
+    return [[int(size), float(100 * c / total)] for size, c in zip(prefix_sizes, correct)]
+
+
+if __name__ == '__main__':
+    from torchvision import transforms, datasets
+    net_file = 'mnist0.5 sigmoid hidden_size[200] test_acc[98.1]'
+    num_planes = 2000
+    working_size = 10000
+    repeats = 5
+    model = torch.load('data/'+net_file+'.pt', map_location='cpu')
+    torch.set_default_tensor_type(torch.FloatTensor)
+    planes = load_planes(net_file)
+    trainset = datasets.MNIST('', download=True, train=True, transform=transforms.ToTensor())
+    testset = datasets.MNIST('', download=True, train=False, transform=transforms.ToTensor())
+    generator = torch.Generator()
+    generator.manual_seed(272727)
+    working = torch.utils.data.Subset(trainset, torch.randperm(len(trainset), generator=generator)[:working_size])
+    images, labels = next(iter(torch.utils.data.DataLoader(working, batch_size=working_size)))
+    x = images.reshape(-1, 784) - 0.5
+    test_loader = torch.utils.data.DataLoader(testset, batch_size=1024, shuffle=False)
+    test_batches = [(images.reshape(-1, 784) - 0.5, labels) for images, labels in test_loader]
+    with torch.no_grad():
+        target = model(x)
+        model_correct = sum([(torch.max(model(images), 1)[1] == labels).sum().item() for images, labels in test_batches])
+        selected, working_curve = greedy_planes(x, target, planes, num_planes, labels=labels, memory_budget=2 ** 30)
+        greedy_curve = selection_curve(test_batches, planes, selected, memory_budget=2 ** 30)
+        sizes = [size for size, accuracy in greedy_curve]
+        random_curve = piecewise_engine.prefix_accuracy_sweep(test_batches, planes['sig_der'], planes['sig_c'],
+                                                              planes['cavex_der'], planes['cavex_c'], sizes,
+                                                              repeats, memory_budget=2 ** 30)
+    print('Model testing accuracy: {} %'.format(100 * model_correct / len(testset)))
+    for (size, accuracy), random_accuracy in zip(greedy_curve, np.mean(random_curve, axis=0)):
+        print("{} planes   greedy = {:.2F}   random = {:.2F}".format(size, accuracy, random_accuracy))
+    # loaded by the scripts with load_planes(net_file + ' greedy'), prefixes keep the greedy order
+    write_planes(planes, selected, store_path(net_file + ' greedy'),
+                 report={'test_curve': greedy_curve, 'working_curve': working_curve})
+    print("Done")
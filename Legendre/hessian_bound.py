@@ -0,0 +1,262 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+# Batched input Hessians of every output for calculate_c. NeuralNet.mixed_act writes into a
+# zeros tensor in place which torch.func cannot vmap, so the forward is rebuilt out of place
+# here, giving the same outputs for every activation in model.functions.
+
+def mixed_act(model, x, layer):
+    act_idxs = model.act_idxs[layer]
+    parts = [model.functions[n_type](x[:, act_idxs[n_type]]) for n_type in model.neuron_types]
+    order = np.concatenate([act_idxs[n_type] for n_type in model.neuron_types])
+    return torch.cat(parts, dim=1)[:, np.argsort(order)]
+
+
+def functional_forward(model, x):
+    out = x
+    for i in range(len(model.layer) - 1):
+        out = mixed_act(model, model.layer[i](out), i)
+    return model.layer[-1](out)
+
+
+def output_hessians(model, x):
+    # [B, out, in, in]
+    def single_output(sample):
+        return functional_forward(model, sample.unsqueeze(0)).squeeze(0)
+    return torch.func.vmap(torch.func.hessian(single_output))(x)
+
+
+def hessian_chunk(model, memory_budget):
+    # the Hessians plus roughly as much again for the forward over backward intermediates
+    num_inputs = model.layer[0].weight.shape[1]
+    num_outputs = model.layer[-1].weight.shape[0]
+    sample_bytes = 3 * num_outputs * num_inputs * num_inputs * model.layer[0].weight.element_size()
+    return max(1, int(memory_budget // sample_bytes))
+
+
+def hessian_eigenvalues(model, all_x, memory_budget=2 ** 30):
+    # eigenvalues of every output's Hessian at every sample, [B, out, in], ascending
+    chunk = hessian_chunk(model, memory_budget)
+    eigen_values = []
+    for start in range(0, len(all_x), chunk):
+        net_hessian = output_hessians(model, all_x[start:start + chunk].detach())
+        # Hessians are symmetric, symmetrise away the rounding so eigvalsh sees exactly that
+        net_hessian = (net_hessian + torch.transpose(net_hessian, 2, 3)) / 2
+        eigen_values.append(torch.linalg.eigvalsh(net_hessian))
+    return torch.vstack(eigen_values)
+
+
+# The per sample, per output loop calculate_c used, kept to check the batched version
+def loop_hessian_eigenvalues(model, all_x, num_outputs):
+    net_hessian = torch.stack([torch.stack([
+        torch.autograd.functional.hessian(model.separate_outputs(out), (all_x[i:i + 1])).squeeze()
+        for out in range(num_outputs)])
+        for i in range(all_x.shape[0])])
+    return torch.stack([torch.stack([
+        torch.linalg.eig(net_hessian[i][out])[0].real
+        for out in range(num_outputs)])
+        for i in range(all_x.shape[0])])
+
+
+def check_hessian_eigenvalues(model, all_x, eigen_values, atol=1e-4):
+    # only the ends of the spectrum are compared, the closed form one leaves out repeated zeros
+    looped = torch.sort(loop_hessian_eigenvalues(model, all_x, eigen_values.shape[1]), dim=2)[0]
+    difference = max(torch.max(torch.abs(looped[:, :, 0] - eigen_values[:, :, 0])).item(),
+                     torch.max(torch.abs(looped[:, :, -1] - eigen_values[:, :, -1])).item())
+    if difference > atol:
+        raise ValueError("batched Hessian eigenvalues differ from the loop by {}".format(difference))
+    return difference
+
+
+# Matrix free alternative, only Hessian vector products of the outputs are needed so nothing
+# of size [in, in] is ever formed. A few dozen Lanczos steps find the extreme eigenvalues.
+
+def output_hvp(model, x, v):
+    # H_k(x_b) v_bk for every sample b and output k, [B, out, in]
+    def single(sample, direction, output):
+        def value(s):
+            return torch.sum(functional_forward(model, s.unsqueeze(0)).squeeze(0) * output)
+        return torch.func.jvp(torch.func.grad(value), (sample,), (direction,))[1]
+    outputs = torch.eye(v.shape[1], dtype=x.dtype, device=x.device)
+    per_output = torch.func.vmap(single, in_dims=(None, 0, 0))
+    return torch.func.vmap(per_output, in_dims=(0, 0, None))(x, v, outputs)
+
+
+def ritz_values(alpha, beta):
+    # extreme eigenvalues of the Lanczos tridiagonal matrices and their residual bounds
+    steps = alpha.shape[2]
+    tridiagonal = torch.diag_embed(alpha) + torch.diag_embed(beta[:, :, :steps - 1], 1) + \
+                  torch.diag_embed(beta[:, :, :steps - 1], -1)
+    theta, vectors = torch.linalg.eigh(tridiagonal)
+    residual = torch.abs(beta[:, :, steps - 1:steps] * vectors[:, :, steps - 1, :])
+    return theta[:, :, 0], residual[:, :, 0], theta[:, :, -1], residual[:, :, -1]
+
+
+def lanczos_extremes(model, x, iterations=30, tol=1e-2, check_every=5, seed=272727):
+    # Lanczos with full reorthogonalisation for every (sample, output) at once
+    num_outputs = model.layer[-1].weight.shape[0]
+    iterations = min(iterations, x.shape[1])
+    generator = torch.Generator(device=x.device)
+    generator.manual_seed(seed)
+    q = torch.randn(x.shape[0], num_outputs, x.shape[1], generator=generator, dtype=x.dtype, device=x.device)
+    q = q / torch.norm(q, dim=2, keepdim=True)
+    basis = [q]
+    alpha = []
+    beta = []
+    for step in range(iterations):
+        w = output_hvp(model, x, q).detach()
+        alpha.append(torch.sum(w * q, dim=2))
+        stacked = torch.stack(basis, dim=2)
+        w = w - torch.matmul(stacked.transpose(2, 3), torch.matmul(stacked, w.unsqueeze(3))).squeeze(3)
+        beta.append(torch.norm(w, dim=2))
+        # an invariant subspace was found, the zero direction just adds a spurious 0 Ritz value
+        q = torch.where(beta[-1].unsqueeze(2) > 1e-10, w / beta[-1].unsqueeze(2).clamp(min=1e-10),
+                        torch.zeros_like(w))
+        basis.append(q)
+        if (step + 1) % check_every == 0 or step + 1 == iterations:
+            lowest, low_residual, highest, high_residual = ritz_values(torch.stack(alpha, dim=2),
+                                                                       torch.stack(beta, dim=2))
+            # tol is relative to the spectral radius of each Hessian
+            scale = torch.maximum(torch.abs(lowest), torch.abs(highest)).clamp(min=1e-12)
+            if torch.all(torch.maximum(low_residual, high_residual) <= tol * scale):
+                break
+    return lowest, low_residual, highest, high_residual
+
+
+def lanczos_eigenvalue_bounds(model, all_x, iterations=30, tol=1e-2, safety=0.05, chunk=1024):
+    # [B, out] lower bound of the smallest and upper bound of the largest Hessian eigenvalue,
+    # widened by the Lanczos residual and a relative safety margin
+    bounds_low = []
+    bounds_high = []
+    for start in range(0, len(all_x), chunk):
+        lowest, low_residual, highest, high_residual = lanczos_extremes(
+            model, all_x[start:start + chunk].detach(), iterations, tol)
+        bounds_low.append(lowest - low_residual - safety * torch.abs(lowest))
+        bounds_high.append(highest + high_residual + safety * torch.abs(highest))
+    return torch.vstack(bounds_low), torch.vstack(bounds_high)
+
+
+# Closed form Hessians for single hidden layer nets, f_k(x) = out_w_k . act(W x + b), so
+# H_k = W^T D_k W with D_k = diag(out_w_k * act''(z)) for elementwise activations. Softmax and
+# softmin act on their whole group of neurons, which gives a dense block of D_k instead.
+
+def elementwise_second_derivative(function, z):
+    if isinstance(function, nn.Sigmoid):
+        s = torch.sigmoid(z)
+        return s * (1 - s) * (1 - 2 * s)
+    if isinstance(function, nn.Tanh):
+        t = torch.tanh(z)
+        return -2 * t * (1 - t * t)
+    if isinstance(function, nn.GELU) and function.approximate == 'none':
+        return torch.exp(-0.5 * z * z) / np.sqrt(2 * np.pi) * (2 - z * z)
+    if isinstance(function, (nn.ReLU, nn.LeakyReLU)):
+        # piecewise linear, zero curvature away from the kinks
+        return torch.zeros_like(z)
+    return None
+
+
+def softmax_curvature(s, a):
+    # Hessian of a . softmax(z) with respect to z, [B, out, n, n]
+    # d2/dz_i dz_j = delta_ij s_i (a_i - a.s) - s_i s_j (a_i - a.s) - s_i s_j (a_j - a.s)
+    centred = a.unsqueeze(0) - torch.matmul(s, torch.transpose(a, 0, 1)).unsqueeze(2)
+    weighted = s.unsqueeze(1) * centred
+    outer = s.unsqueeze(1).unsqueeze(3) * weighted.unsqueeze(2)
+    return torch.diag_embed(weighted) - outer - torch.transpose(outer, 2, 3)
+
+
+def hidden_curvature(model, x):
+    # D_k for every sample and output, [B, out, hidden, hidden]
+    if len(model.layer) != 2:
+        raise ValueError("closed form Hessians need a single hidden layer, this net has {}".format(
+            len(model.layer) - 1))
+    z = model.layer[0](x)
+    out_w = model.layer[1].weight
+    curvature = torch.zeros(len(x), out_w.shape[0], out_w.shape[1], out_w.shape[1], dtype=x.dtype, device=x.device)
+    for n_type in model.neuron_types:
+        idx = torch.as_tensor(model.act_idxs[0][n_type], device=x.device)
+        if len(idx) == 0:
+            continue
+        function = model.functions[n_type]
+        block = idx.unsqueeze(1), idx.unsqueeze(0)
+        second = elementwise_second_derivative(function, z[:, idx])
+        if second is not None:
+            curvature[:, :, block[0], block[1]] = torch.diag_embed(out_w[:, idx].unsqueeze(0) * second.unsqueeze(1))
+        elif isinstance(function, nn.Softmax):
+            curvature[:, :, block[0], block[1]] = softmax_curvature(torch.softmax(z[:, idx], dim=1), out_w[:, idx])
+        elif isinstance(function, nn.Softmin):
+            # softmin(z) = softmax(-z), the two sign flips cancel in the second derivative
+            curvature[:, :, block[0], block[1]] = softmax_curvature(torch.softmax(-z[:, idx], dim=1), out_w[:, idx])
+        else:
+            raise ValueError("no closed form Hessian for {} neurons".format(n_type))
+    return curvature
+
+
+def analytic_hessian_eigenvalues(model, all_x, memory_budget=2 ** 30):
+    # [B, out, rank] nonzero part of the spectrum of W^T D_k W, rank = min(hidden, in). When
+    # hidden <= in the spectrum equals that of G^1/2 D_k G^1/2 with G = W W^T, so only
+    # hidden x hidden matrices are decomposed.
+    w = model.layer[0].weight.detach()
+    num_outputs, hidden_size = model.layer[1].weight.shape
+    small_side = hidden_size <= w.shape[1]
+    if small_side:
+        gram_values, gram_vectors = torch.linalg.eigh(torch.matmul(w, torch.transpose(w, 0, 1)))
+        gram_root = torch.matmul(gram_vectors * torch.sqrt(torch.clamp(gram_values, min=0)),
+                                 torch.transpose(gram_vectors, 0, 1))
+    side = min(hidden_size, w.shape[1])
+    chunk = max(1, int(memory_budget // (3 * num_outputs * max(side, hidden_size) ** 2 * w.element_size())))
+    eigen_values = []
+    with torch.no_grad():
+        for start in range(0, len(all_x), chunk):
+            curvature = hidden_curvature(model, all_x[start:start + chunk])
+            if small_side:
+                reduced = torch.matmul(torch.matmul(gram_root, curvature), gram_root)
+            else:
+                reduced = torch.matmul(torch.matmul(torch.transpose(w, 0, 1), curvature), w)
+            reduced = (reduced + torch.transpose(reduced, 2, 3)) / 2
+            eigen_values.append(torch.linalg.eigvalsh(reduced))
+    eigen_values = torch.vstack(eigen_values)
+    if hidden_size < w.shape[1]:
+        # the null space of W adds zero eigenvalues
+        zeros = torch.zeros(eigen_values.shape[:2] + (1,), dtype=eigen_values.dtype, device=eigen_values.device)
+        eigen_values = torch.sort(torch.cat([eigen_values, zeros], dim=2), dim=2)[0]
+    return eigen_values
+
+
+def analytic_eigenvalue_bounds(model, all_x):
+    # [B, out] guaranteed lower/upper bounds of the Hessian spectrum without any decomposition
+    # per sample. W^T D W >= W^T D_- W, and the negative part is bounded both by the trace
+    # sum_h |d_h-| |w_h|^2 and by max_h |d_h-| ||W||^2, whichever is tighter. Softmax blocks
+    # are dense so their own extreme eigenvalue times ||W_S||^2 is used instead.
+    w = model.layer[0].weight.detach()
+    out_w = model.layer[1].weight.detach()
+    with torch.no_grad():
+        z = model.layer[0](all_x)
+        lowest = torch.zeros(len(all_x), out_w.shape[0], dtype=all_x.dtype, device=all_x.device)
+        highest = torch.zeros_like(lowest)
+        for n_type in model.neuron_types:
+            idx = torch.as_tensor(model.act_idxs[0][n_type], device=all_x.device)
+            if len(idx) == 0:
+                continue
+            function = model.functions[n_type]
+            w_norm = torch.linalg.matrix_norm(w[idx], ord=2) ** 2
+            second = elementwise_second_derivative(function, z[:, idx])
+            if second is not None:
+                d = out_w[:, idx].unsqueeze(0) * second.unsqueeze(1)
+                row_norms = torch.sum(w[idx] * w[idx], dim=1)
+                lowest -= torch.minimum(torch.matmul(torch.clamp(-d, min=0), row_norms),
+                                        torch.max(torch.clamp(-d, min=0), dim=2)[0] * w_norm)
+                highest += torch.minimum(torch.matmul(torch.clamp(d, min=0), row_norms),
+                                         torch.max(torch.clamp(d, min=0), dim=2)[0] * w_norm)
+                continue
+            if isinstance(function, nn.Softmax):
+                block = softmax_curvature(torch.softmax(z[:, idx], dim=1), out_w[:, idx])
+            elif isinstance(function, nn.Softmin):
+                block = softmax_curvature(torch.softmax(-z[:, idx], dim=1), out_w[:, idx])
+            else:
+                raise ValueError("no closed form Hessian for {} neurons".format(n_type))
+            block_values = torch.linalg.eigvalsh(block)
+            lowest += torch.clamp(block_values[:, :, 0], max=0) * w_norm
+            highest += torch.clamp(block_values[:, :, -1], min=0) * w_norm
+    return lowest, highest
@@ -14,6 +14,12 @@ import gc
 import itertools
 from tqdm import tqdm
 from Legendre.train_mnist import NeuralNet
+from Legendre.implicit_planes import AnchorCavexPlanes
+from Legendre.plane_extraction import output_planes
+from Legendre import piecewise_engine
+from Legendre.hessian_bound import hessian_eigenvalues, check_hessian_eigenvalues, lanczos_eigenvalue_bounds, \
+    analytic_hessian_eigenvalues, analytic_eigenvalue_bounds
+from Legendre.anchor_index import build_index, benchmark_index
 
 sns.set_theme(style="whitegrid")
 
@@ -48,115 +54,54 @@ net_file = 'mnist0.5 sigmoid hidden_size[200] test_acc[98.1]'
 model = torch.load('data/'+net_file+'.pt')
 
 num_outputs = 10
+memory_budget = 2 ** 30  # bytes of plane responses per piecewise_value call, None for all at once
+index_backend = None  # 'brute', 'ball' or 'ivf' finds the mindex cavex winner with a nearest anchor index
+index_queries = 1024  # test images the index is benchmarked on
+hessian_budget = 2 ** 30  # bytes of Hessians per chunk in calculate_c
+check_hessian = False
+check_extraction = False  # compare output_planes with the per output backward loop
+analytic_c = None  # 'exact' or 'bound' for the closed form Hessians of single hidden layer nets
+lanczos_c = False  # matrix free Lanczos eigenvalue bounds instead of full Hessians, for bigger nets
+lanczos_iterations = 30
+lanczos_safety = 0.05  # relative margin, with the Lanczos residual it takes the place of margin_of_error
 
 def calculate_c(model, all_x):
-    net_hessian = torch.stack([torch.stack([
-        torch.autograd.functional.hessian(model.separate_outputs(out), (all_x[i:i + 1])).squeeze()
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
-
-    eigen_values = torch.stack([torch.stack([
-        torch.linalg.eig(net_hessian[i][out])[0].real
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
+    if lanczos_c:
+        lowest, highest = lanczos_eigenvalue_bounds(model, all_x, lanczos_iterations, safety=lanczos_safety)
+        # kept above 0 so the cavex constant stays positive
+        return torch.max(torch.clamp(-lowest, min=1e-8), dim=0)[0]
+
+    if analytic_c == 'exact':
+        eigen_values = analytic_hessian_eigenvalues(model, all_x, memory_budget=hessian_budget)
+    elif analytic_c == 'bound':
+        # only the two ends of the spectrum, which is all the reductions below look at
+        eigen_values = torch.stack(analytic_eigenvalue_bounds(model, all_x), dim=2)
+    else:
+        # [B, out, in] eigenvalues, vmapped Hessians and eigvalsh in chunks of hessian_budget bytes
+        eigen_values = hessian_eigenvalues(model, all_x, memory_budget=hessian_budget)
+    if check_hessian and analytic_c != 'bound':
+        check_hessian_eigenvalues(model, all_x, eigen_values)
 
     margin_of_error = 0.0001
-    cavex_c = torch.stack([torch.stack([
-        torch.max(
-            -torch.min(torch.hstack([
-                eigen_values[i][out], torch.tensor(0)]))) + margin_of_error
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
+    cavex_c = torch.clamp(-torch.min(eigen_values, dim=2)[0], min=0) + margin_of_error
 
     output_c = torch.max(cavex_c, dim=0)
 
     return output_c[0]
 
 def piecewise_value(x, net_m, net_c, cavex_m, cavex_c, max_mindex=False):
-    # if max_mindex:
-    #     sy = []
-    #     cavexy = []
-    #     for sm, sc, cvm, cvc in zip(net_m, net_c, cavex_m, cavex_c):
-    #         smx = torch.matmul(x, sm)
-    #         cavexx = torch.matmul(x, cvm)
-    #         sy.append(smx + sc)
-    #         cavexy.append(cavexx + cvc)
-    #     sy = torch.stack(sy)
-    #     cavexy = torch.stack(cavexy)
-    #     max_vex_max3 = torch.max(cavexy, dim=0)[1]
-    #     # min_cave_min3 = torch.min(-cavexy, dim=0)[1]
-    #     vex_sy = torch.stack([torch.stack(
-    #         [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max3)])
-    #     # cave_sy = torch.stack([torch.stack(
-    #     #     [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min3)])
-    #     # y = (vex_sy + cave_sy) / 2
-    #     y = vex_sy
-    # else:
-    #     vexy = []
-    #     cavey = []
-    #     for sm, sc, cvm, cvc in zip(net_m, net_c, cavex_m, cavex_c):
-    #         vexx = torch.matmul(x, sm + cvm)
-    #         cavex = torch.matmul(x, sm - cvm)
-    #         vexy.append(vexx + cvc + sc)
-    #         cavey.append(cavex - cvc + sc)
-    #     vexy = torch.stack(vexy)
-    #     cavey = torch.stack(cavey)
-    #     y_max = torch.max(vexy, dim=0)[0]
-    #     y_min = torch.min(cavey, dim=0)[0]
-    #     y = (y_min + y_max) / 2
-    # return y
-    sy = []
-    vexy = []
-    cavey = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(net_m, net_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, torch.transpose(sm, 0, 1))
-        vexx = torch.matmul(x, torch.transpose(sm + cvm, 0, 1))
-        cavex = torch.matmul(x, torch.transpose(sm - cvm, 0, 1))
-        cavexx = torch.matmul(x, torch.transpose(cvm, 0, 1))
-        sy.append((smx + sc))
-        vexy.append((vexx + cvc + sc))
-        cavey.append((cavex - cvc + sc))
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    vexy = torch.stack(vexy)
-    cavey = torch.stack(cavey)
-    cavexy = torch.stack(cavexy)
-    y_max = torch.max(vexy, dim=2)[0]
-    y_min = torch.min(cavey, dim=2)[0]
-    # max_vex_max = torch.max(vexy, dim=2)[1]
-    # min_cave_min = torch.min(cavey, dim=2)[1]
-    # max_vex_max2 = torch.max(sy + cavexy, dim=2)[1]
-    # min_cave_min2 = torch.min(sy - cavexy, dim=2)[1]
-    max_vex_max3 = torch.max(cavexy, dim=2)[1]
-    min_cave_min3 = torch.min(-cavexy, dim=2)[1]
-    vex_sy = torch.stack([torch.stack(
-        [sy[j][i][output_i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max3)])
-    cave_sy = torch.stack([torch.stack(
-        [sy[j][i][output_i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min3)])
-    # if max_mindex:
-    #     y = torch.transpose((vex_sy + cave_sy) / 2, 0, 1)
-    # else:
-    #     y = torch.transpose((y_min + y_max) / 2, 0, 1)
-    return torch.transpose((y_min + y_max) / 2, 0, 1), torch.transpose((vex_sy + cave_sy) / 2, 0, 1)
-    # if soft:
-    #     temperature = .01
-        # if vex:
-        #     return torch.sum(y * torch.exp(y / temperature) / torch.sum(torch.exp(y / temperature)))
-        # else:
-        #     return torch.sum(y * torch.exp(-y / temperature) / torch.sum(torch.exp(-y / temperature)))
-    # else:
-    #     if vex:
-    #         return torch.max(y, dim=0)[0]
-    #     else:
-    #         return torch.min(y, dim=0)[0]
+    if cavex_index is not None:
+        # the envelope needs every plane so only the mindex output is returned
+        mindex_y = piecewise_engine.indexed_piecewise_value(x, net_m, net_c, cavex_index, output_first=True)
+        return None, mindex_y
+    # returns the min/max envelope and the mindex outputs, both [B, out]
+    return piecewise_engine.piecewise_value(x, net_m, net_c, cavex_m, cavex_c, output_first=True,
+                                            memory_budget=memory_budget)
 
 net_out = []
 net_m = []
 net_c = []
-cavex_out = []
-cavex_m = []
-cavex_c = []
+cavex_anchors = []
 
 hidden_size = model.layer[0].bias.shape[0]
 
@@ -178,37 +123,39 @@ print("calculating Legendre planes")
 for images, labels in tqdm(train_loader):
     images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
 
-    images.requires_grad = True
-    n_out = []
-    n_m = []
-    for out in range(num_outputs):
-        n_out.append(model.separate_outputs(out)(images))
-        n_out[-1].backward(torch.ones(images.shape[0]))
-        n_m.append(images.grad.clone().detach())
-        images.grad = None
-        n_out[-1].detach()
-    images.requires_grad = False
+    # every output's plane from one vmapped jacrev instead of a backward per output
+    n_out, n_m, n_c = output_planes(images, model, check=check_extraction)
 
     with torch.no_grad():
         x2_out = torch.sum(images * images, dim=1)
-        cx2 = 0.5 * torch.stack([torch.sum(images * images, dim=1) * c for c in cavex_const])
-        cx2_grad = torch.stack([images * c for c in cavex_const])
-
-        net_out.append(torch.stack(n_out))
-        net_m.append(torch.stack(n_m))
-        net_c.append(torch.stack([
-            n_out[out] - torch.sum(n_m[out] * images, dim=1) for out in range(num_outputs)
-        ]))
-        cavex_out.append(cx2)
-        cavex_m.append(cx2_grad)
-        cavex_c.append(cx2 - torch.sum(cx2_grad * images, dim=2))
+
+        net_out.append(n_out)
+        net_m.append(n_m)
+        net_c.append(n_c)
+        cavex_anchors.append(images.detach())
 
 # net_out = torch.hstack(net_out)
 net_m = torch.hstack(net_m)
 net_c = torch.hstack(net_c)
-# cavex_out = torch.hstack(cavex_out)
-cavex_m = torch.hstack(cavex_m)
-cavex_c = torch.hstack(cavex_c)
+cavex_m = AnchorCavexPlanes(torch.vstack(cavex_anchors), cavex_const)
+cavex_c = cavex_m.intercepts()
+
+cavex_index = None
+if index_backend is not None:
+    print("building {} anchor index".format(index_backend))
+    cavex_index = build_index(cavex_m.anchors, index_backend)
+    # winner recall, speedup and the mindex accuracy lost against the exact winners
+    index_x = []
+    index_labels = []
+    for images, labels in test_loader:
+        index_x.append(images.reshape(-1, 784).to(torch.device(device)) - 0.5)
+        index_labels.append(labels.to(torch.device(device)))
+        if sum([len(l) for l in index_labels]) >= index_queries:
+            break
+    index_x = torch.vstack(index_x)
+    print(benchmark_index(cavex_index, index_x, labels=torch.hstack(index_labels),
+                          classify=lambda winners: piecewise_engine.selected_response(
+                              index_x, net_m, net_c, winners, output_first=True)))
 
 print('', end='')
 
@@ -237,8 +184,10 @@ with torch.no_grad():
         correct_m += (pred == labels).sum().item()
 
         out_l, mindex_out_l = piecewise_value(images, net_m, net_c, cavex_m, cavex_c)
-        _, pred = torch.max(out_l, 1)
-        correct_l += (pred == labels).sum().item()
+        if out_l is not None:
+            _, pred = torch.max(out_l, 1)
+            correct_l += (pred == labels).sum().item()
+            all_l.append(out_l)
 
         _, pred = torch.max(mindex_out_l, 1)
         correct_mindex += (pred == labels).sum().item()
@@ -246,17 +195,20 @@ with torch.no_grad():
         total += labels.size(0)
 
         all_m.append(out_m)
-        all_l.append(out_l)
         all_mindex.append(mindex_out_l)
 
 print("Current total {}".format(total))
 print('Model testing accuracy: {} %'.format(100 * correct_m / total))
-print('Legendre testing accuracy: {} %'.format(100 * correct_l / total))
+if cavex_index is None:
+    print('Legendre testing accuracy: {} %'.format(100 * correct_l / total))
+else:
+    print('Legendre envelope not evaluated, the {} index only gives the mindex output'.format(index_backend))
 print('Mindex Legendre testing accuracy: {} %'.format(100 * correct_mindex / total))
 all_m = torch.vstack(all_m)
-all_l = torch.vstack(all_l)
 all_mindex = torch.vstack(all_mindex)
-print("Legendre difference", torch.sum(torch.abs(all_m - all_l)))
+if cavex_index is None:
+    all_l = torch.vstack(all_l)
+    print("Legendre difference", torch.sum(torch.abs(all_m - all_l)))
 print("Minmax Legendre difference", torch.sum(torch.abs(all_m - all_mindex)))
 
 print("calculating training accuracy")
@@ -275,8 +227,10 @@ with torch.no_grad():
         correct_m += (pred == labels).sum().item()
 
         out_l, mindex_out_l = piecewise_value(images, net_m, net_c, cavex_m, cavex_c)
-        _, pred = torch.max(out_l, 1)
-        correct_l += (pred == labels).sum().item()
+        if out_l is not None:
+            _, pred = torch.max(out_l, 1)
+            correct_l += (pred == labels).sum().item()
+            all_l.append(out_l)
 
         _, pred = torch.max(mindex_out_l, 1)
         correct_mindex += (pred == labels).sum().item()
@@ -284,17 +238,20 @@ with torch.no_grad():
         total += labels.size(0)
 
         all_m.append(out_m)
-        all_l.append(out_l)
         all_mindex.append(mindex_out_l)
 
 print("Current total {}".format(total))
 print('Model testing accuracy: {} %'.format(100 * correct_m / total))
-print('Legendre testing accuracy: {} %'.format(100 * correct_l / total))
+if cavex_index is None:
+    print('Legendre testing accuracy: {} %'.format(100 * correct_l / total))
+else:
+    print('Legendre envelope not evaluated, the {} index only gives the mindex output'.format(index_backend))
 print('Mindex Legendre testing accuracy: {} %'.format(100 * correct_mindex / total))
 all_m = torch.vstack(all_m)
-all_l = torch.vstack(all_l)
 all_mindex = torch.vstack(all_mindex)
-print("Legendre difference", torch.sum(torch.abs(all_m - all_l)))
+if cavex_index is None:
+    all_l = torch.vstack(all_l)
+    print("Legendre difference", torch.sum(torch.abs(all_m - all_l)))
 print("Minmax Legendre difference", torch.sum(torch.abs(all_m - all_mindex)))
 
 print("Done")
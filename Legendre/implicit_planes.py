@@ -0,0 +1,99 @@
+import torch
+from Legendre.plane_extraction import hidden_activation
+
+
+# Sigmoid planes of a single hidden layer net stored in factorized form. The gradient of
+# every plane is W^T diag(out_w * s'(x_i)) so it is fully described by the hidden
+# derivative s'(x_i) of its anchor, plus the two weight matrices that are shared by all
+# planes. sig_c is small ([L, out]) and kept as is.
+class FactorizedSigPlanes:
+    def __init__(self, hidden_der, sig_c, w, out_w):
+        self.hidden_der = hidden_der
+        self.sig_c = sig_c
+        self.w = w
+        self.out_w = out_w
+
+    @classmethod
+    def from_model(cls, model, hidden_der, sig_c):
+        return cls(hidden_der, sig_c,
+                   model.layer[0].weight.data.type(hidden_der.dtype),
+                   model.layer[1].weight.data.type(hidden_der.dtype))
+
+    @classmethod
+    def from_images(cls, images, model):
+        sig = torch.sigmoid(hidden_activation(images, model))
+        hidden_der = sig * (1 - sig)
+        planes = cls.from_model(model, hidden_der, None)
+        # intercept = s(Wx_i + b) out_w^T - x_i . grad
+        hidden = torch.matmul(images, torch.transpose(planes.w, 0, 1))
+        planes.sig_c = torch.matmul(sig - hidden * hidden_der, torch.transpose(planes.out_w, 0, 1))
+        return planes
+
+    @classmethod
+    def from_dense(cls, sig_der, sig_c, model, chunk=1024):
+        # recovers s'(x_i) from saved dense planes, only possible when hidden size <= input size
+        w = model.layer[0].weight.data.type(sig_der.dtype)
+        out_w = model.layer[1].weight.data.type(sig_der.dtype)
+        if w.shape[0] > w.shape[1]:
+            raise ValueError("cannot factorize planes of a net with more hidden neurons ({}) than inputs ({})".format(
+                w.shape[0], w.shape[1]))
+        pin_w = torch.pinverse(torch.transpose(w, 0, 1))
+        hidden_der = []
+        for start in range(0, len(sig_der), chunk):
+            scaled = torch.matmul(pin_w, sig_der[start:start + chunk])
+            hidden_der.append(torch.sum(scaled * torch.transpose(out_w, 0, 1), dim=2) /
+                              torch.sum(torch.square(out_w), dim=0))
+        return cls(torch.vstack(hidden_der), sig_c[:], w, out_w)
+
+    def __len__(self):
+        return len(self.hidden_der)
+
+    def __getitem__(self, index):
+        return FactorizedSigPlanes(self.hidden_der[index], self.sig_c[index], self.w, self.out_w)
+
+    def hidden_response(self, hidden, hidden_der):
+        # ((x W^T) * d) out_w^T for every pairing of sample and anchor in one GEMM
+        scaled = hidden.unsqueeze(1) * self.out_w
+        out = torch.matmul(scaled.reshape(-1, scaled.shape[2]), torch.transpose(hidden_der, 0, 1))
+        return out.reshape(hidden.shape[0], self.out_w.shape[0], -1).permute(2, 0, 1)
+
+    def response(self, x):
+        # same values as stacking torch.matmul(x, sm) + sc over the dense planes, [L, B, out]
+        hidden = torch.matmul(x, torch.transpose(self.w, 0, 1))
+        return self.hidden_response(hidden, self.hidden_der) + self.sig_c.unsqueeze(1)
+
+    def dense(self):
+        return torch.matmul(torch.transpose(self.w, 0, 1),
+                            self.hidden_der.unsqueeze(2) * torch.transpose(self.out_w, 0, 1))
+
+
+# The quadratic cavex planes c_k * x_i . x - 0.5 * c_k * |x_i|^2 only differ between outputs
+# by the constant c_k, so instead of an [out, L, in] stack of scaled images they are kept as
+# the anchor matrix, the per output constants and the cached anchor norms.
+class AnchorCavexPlanes:
+    def __init__(self, anchors, cavex_const, anchor_norms=None):
+        self.anchors = anchors
+        self.cavex_const = cavex_const
+        if anchor_norms is None:
+            anchor_norms = torch.sum(anchors * anchors, dim=1)
+        self.anchor_norms = anchor_norms
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def __getitem__(self, index):
+        return AnchorCavexPlanes(self.anchors[index], self.cavex_const, self.anchor_norms[index])
+
+    def shared_response(self, x):
+        # x . x_i - 0.5 * |x_i|^2, the same for every output, [B, L]
+        return torch.matmul(x, torch.transpose(self.anchors, 0, 1)) - 0.5 * self.anchor_norms
+
+    def response(self, x):
+        # same values as stacking x @ cavex_m[k]^T + cavex_c[k] over outputs, [out, B, L]
+        return self.cavex_const.reshape(-1, 1, 1) * self.shared_response(x)
+
+    def gradients(self):
+        return self.cavex_const.reshape(-1, 1, 1) * self.anchors
+
+    def intercepts(self):
+        return -0.5 * self.cavex_const.unsqueeze(1) * self.anchor_norms
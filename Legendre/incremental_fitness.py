@@ -0,0 +1,81 @@
+import torch
+from Legendre import piecewise_engine
+
+
+# Incremental GA scoring for LeGAendre.py. For every sample of a fixed evaluation set and every
+# output an agent's state keeps its two best cavex planes: their cavex scores, plane indices and
+# sig values, each [2, N, out]. A child that swapped a few genes is scored from its parent's
+# state by dropping the removed planes and merging in the responses of only the added planes.
+# Once a state has lost one of its top two the runner up is unknown (second_valid is False);
+# only samples whose winner was removed without a known runner up need the full genome again.
+
+class IncrementalFitness:
+    def __init__(self, batches, sig_der, sig_c, cavex_der, cavex_c):
+        # batches is the fixed evaluation set as a list of (images, labels) ready for the planes
+        self.batches = batches
+        self.labels = torch.hstack([labels for images, labels in batches])
+        self.offsets = [0]
+        for images, labels in batches:
+            self.offsets.append(self.offsets[-1] + len(images))
+        self.planes = sig_der, sig_c, cavex_der, cavex_c
+        self.planes_evaluated = 0
+        self.fallbacks = 0
+
+    def gene_planes(self, genes):
+        # read once per call and shared by every batch, the planes may be PlaneStore arrays
+        self.planes_evaluated += len(genes)
+        return [planes[genes] for planes in self.planes]
+
+    def batch_state(self, images, genome, genome_planes):
+        sy, cavexy = piecewise_engine.plane_responses(images, *genome_planes)
+        scores, index = torch.topk(cavexy, 2, dim=0)
+        return scores, genome[index], torch.gather(sy, 0, index)
+
+    def full_state(self, genome):
+        genome_planes = self.gene_planes(genome)
+        states = [self.batch_state(images, genome, genome_planes) for images, labels in self.batches]
+        scores, planes, values = [torch.cat(parts, dim=1) for parts in zip(*states)]
+        return {'scores': scores, 'planes': planes, 'values': values,
+                'second_valid': torch.ones(scores.shape[1:], dtype=torch.bool, device=scores.device)}
+
+    def child_state(self, parent_state, parent_genome, child_genome):
+        removed = parent_genome[~torch.isin(parent_genome, child_genome)]
+        added = child_genome[~torch.isin(child_genome, parent_genome)]
+        if not len(removed) and not len(added):
+            return parent_state
+        scores, planes, values = parent_state['scores'], parent_state['planes'], parent_state['values']
+        gone = torch.isin(planes, removed)
+        fallback = gone[0] & (gone[1] | ~parent_state['second_valid'])
+        second_valid = parent_state['second_valid'] & ~torch.any(gone, dim=0)
+        scores = torch.where(gone, -float('inf'), scores)
+        if len(added):
+            added_planes = self.gene_planes(added)
+            added_responses = [piecewise_engine.plane_responses(images, *added_planes)
+                               for images, labels in self.batches]
+            added_sy, added_cavexy = [torch.cat(parts, dim=1) for parts in zip(*added_responses)]
+            scores = torch.cat([scores, added_cavexy])
+            planes = torch.cat([planes, added.reshape(-1, 1, 1).expand(-1, planes.shape[1], planes.shape[2])])
+            values = torch.cat([values, added_sy])
+        scores, index = torch.topk(scores, 2, dim=0)
+        state = {'scores': scores,
+                 'planes': torch.gather(planes, 0, index),
+                 'values': torch.gather(values, 0, index),
+                 'second_valid': second_valid}
+        child_planes = None
+        for batch, (images, labels) in enumerate(self.batches):
+            start, end = self.offsets[batch], self.offsets[batch + 1]
+            if torch.any(fallback[start:end]):
+                self.fallbacks += 1
+                if child_planes is None:
+                    child_planes = self.gene_planes(child_genome)
+                batch_scores, batch_planes, batch_values = self.batch_state(images, child_genome, child_planes)
+                state['scores'][:, start:end] = batch_scores
+                state['planes'][:, start:end] = batch_planes
+                state['values'][:, start:end] = batch_values
+                state['second_valid'][start:end] = True
+        return state
+
+    def fitness(self, state):
+        # testing accuracy in % of the mindex output
+        _, pred = torch.max(state['values'][0], 1)
+        return 100 * (pred == self.labels).to(torch.float32).mean().item()
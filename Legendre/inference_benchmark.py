@@ -0,0 +1,172 @@
+import os
+import sys
+import copy
+import json
+import platform
+import subprocess
+import time
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+from Legendre import piecewise_engine
+from Legendre.plane_store import PlaneStore, store_path
+
+
+# CPU benchmark of network inference against piecewise_value inference. Every case is warmed
+# up, timed over repeats with percentiles reported, and run once more under the profiler for
+# the peak tensor memory. Results are a list of json rows, one per (batch size, dtype, threads)
+# for the network and per plane count as well for the Legendre planes, with the Legendre time
+# as a multiple of the network time so the planes per network break even can be tracked.
+
+def time_function(function, warmup=3, repeats=20):
+    for w in range(warmup):
+        function()
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {'mean_ms': float(np.mean(times)),
+            'min_ms': float(np.min(times)),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)),
+            'p99_ms': float(np.percentile(times, 99))}
+
+
+def peak_memory(function):
+    # largest total of live tensor bytes allocated while function runs, from the profiler's
+    # allocation and free records in time order
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        function()
+    events = sorted(prof.events(), key=lambda event: event.time_range.start)
+    live = 0
+    peak = 0
+    for event in events:
+        live += event.self_cpu_memory_usage
+        peak = max(peak, live)
+    return int(peak)
+
+
+def benchmark_case(function, warmup=3, repeats=20):
+    with torch.no_grad():
+        result = time_function(function, warmup, repeats)
+        result['peak_memory_bytes'] = peak_memory(function)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {'commit': git_commit(),
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count()}
+
+
+def random_planes(num_planes, input_size=784, num_outputs=10, seed=272727):
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return {'sig_der': torch.randn(num_planes, input_size, num_outputs, generator=generator) * 0.01,
+            'sig_c': torch.randn(num_planes, num_outputs, generator=generator),
+            'cavex_der': torch.randn(num_planes, input_size, num_outputs, generator=generator) * 0.01,
+            'cavex_c': torch.randn(num_planes, num_outputs, generator=generator)}
+
+
+def run_benchmark(model, planes, plane_counts, batch_sizes, dtypes=(torch.float32,), threads=(1,),
+                  warmup=3, repeats=20, memory_budget=None, input_size=784, seed=272727):
+    # planes is a dict of plane first sig_der, sig_c, cavex_der, cavex_c, tensors or store arrays
+    # holding at least max(plane_counts) planes, the first n are used for a count of n
+    default_threads = torch.get_num_threads()
+    default_dtype = torch.get_default_dtype()
+    most = max(plane_counts)
+    loaded = {name: piecewise_engine.as_tensor(planes[name][:most]).cpu()
+              for name in ['sig_der', 'sig_c', 'cavex_der', 'cavex_c']}
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    rows = []
+    for dtype in dtypes:
+        # NeuralNet.mixed_act builds its output in the default dtype
+        torch.set_default_dtype(dtype)
+        dtype_model = copy.deepcopy(model).cpu().to(dtype).eval()
+        dtype_planes = {name: p.to(dtype) for name, p in loaded.items()}
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            for batch_size in batch_sizes:
+                x = (torch.rand(batch_size, input_size, generator=generator) - 0.5).to(dtype)
+                setting = {'batch_size': batch_size, 'dtype': str(dtype).replace('torch.', ''),
+                           'threads': num_threads}
+                network = benchmark_case(lambda: dtype_model(x), warmup, repeats)
+                rows.append(dict(setting, method='network', planes=None, **network))
+                print(rows[-1])
+                for num_planes in plane_counts:
+                    p = {name: values[:num_planes] for name, values in dtype_planes.items()}
+                    legendre = benchmark_case(lambda: piecewise_engine.piecewise_value(
+                        x, p['sig_der'], p['sig_c'], p['cavex_der'], p['cavex_c'], memory_budget=memory_budget),
+                        warmup, repeats)
+                    legendre['network_ratio'] = legendre['p50_ms'] / network['p50_ms']
+                    rows.append(dict(setting, method='legendre', planes=num_planes, **legendre))
+                    print(rows[-1])
+    torch.set_num_threads(default_threads)
+    torch.set_default_dtype(default_dtype)
+    return rows
+
+
+def break_even(rows):
+    # largest plane count whose median time is within the network's, per setting
+    settings = {}
+    for row in rows:
+        if row['method'] != 'legendre':
+            continue
+        key = '{} {} threads{}'.format(row['batch_size'], row['dtype'], row['threads'])
+        settings.setdefault(key, None)
+        if row['network_ratio'] <= 1 and (settings[key] is None or row['planes'] > settings[key]):
+            settings[key] = row['planes']
+    return settings
+
+
+def save_benchmark(rows, path, config=None):
+    result = {'environment': environment(), 'config': config, 'break_even_planes': break_even(rows),
+              'results': rows}
+    with open(path, 'w') as result_file:
+        json.dump(result, result_file, indent=1)
+    return result
+
+
+if __name__ == '__main__':
+    net_file = 'mnist0.5 sigmoid hidden_size[200] test_acc[98.1]'
+    output_path = sys.argv[1] if len(sys.argv) > 1 else 'data/inference benchmark.json'
+    config = {'plane_counts': [100, 200, 500, 1100, 2000, 5000],
+              'batch_sizes': [1, 32, 128, 1024],
+              'dtypes': ['float32', 'float64'],
+              'threads': sorted(set([1, max(1, os.cpu_count() // 2)])),
+              'warmup': 3,
+              'repeats': 20,
+              'memory_budget': None}
+    if os.path.exists('data/'+net_file+'.pt'):
+        model = torch.load('data/'+net_file+'.pt', map_location='cpu')
+    else:
+        # same inference cost as the 200 sigmoid neuron net
+        print("no saved net, timing an untrained 784-200-10 sigmoid net")
+        model = torch.nn.Sequential(torch.nn.Linear(784, 200), torch.nn.Sigmoid(),
+                                    torch.nn.Linear(200, 10, bias=False))
+    # after the load, nothing it imports may leave the default tensors on cuda
+    torch.set_default_tensor_type(torch.FloatTensor)
+    if os.path.exists(os.path.join(store_path(net_file), 'meta.json')):
+        planes = PlaneStore(store_path(net_file))
+    else:
+        print("no plane store, timing random planes")
+        planes = random_planes(max(config['plane_counts']))
+    rows = run_benchmark(model, planes, config['plane_counts'], config['batch_sizes'],
+                         [getattr(torch, dtype) for dtype in config['dtypes']], config['threads'],
+                         config['warmup'], config['repeats'], config['memory_budget'])
+    result = save_benchmark(rows, output_path, config)
+    print("Planes within the network's time:", result['break_even_planes'])
+    print("Done")
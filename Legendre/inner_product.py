@@ -16,6 +16,8 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_store import load_planes
+from Legendre.plane_similarity import top_similar
 
 sn.set_theme(style="whitegrid")
 
@@ -108,27 +110,15 @@ def inner_products(original, cavex):
     #     print(torch.topk(-torch.stack(corr_row), 10)[0])
     #     org_corr.append(torch.stack(corr_row))
 
-    length = len(cavex)
-    print("inv org")
-    pin_cavex = torch.stack([torch.pinverse(cavex[i]) for i in tqdm(range(len(cavex)))])
-    print("mult org")
-    org_corr = []
-    for i in tqdm(range(length)):
-        corr_row = []
-        for j in range(length):
-            inv_or_I = torch.matmul(pin_cavex[i], cavex[j])
-            difference = torch.sum(torch.square(torch.eye(inv_or_I.shape[0]) - inv_or_I))
-            corr_row.append(difference)
-        print(torch.topk(-torch.stack(corr_row), 10)[0])
-        org_corr.append(torch.stack(corr_row))
-
-    # org_corr = torch.stack([torch.stack([
-    #     torch.matmul(pin_original[i], original[j]) for j in range(length)]) for i in range(length)])
-    print("inv cavex")
-    pin_cavex = torch.stack([torch.pinverse(cavex[i]) for i in range(len(cavex))])
-    print("mult cavex")
-    cavex_corr = torch.stack([torch.stack([
-        torch.matmul(pin_cavex[i], cavex[j]) for j in range(length)]) for i in range(length)])
+    # the similarity_k smallest |I - pinv(A_i) A_j|^2 of every plane, a block of pairs at a time
+    print("similar original planes")
+    org_corr, org_index = top_similar(original, similarity_k, similarity_block)
+    print(org_corr[:10], org_index[:10])
+    print("similar cavex planes")
+    cavex_corr, cavex_index = top_similar(cavex, similarity_k, similarity_block)
+    print(cavex_corr[:10], cavex_index[:10])
+    org_corr = org_corr[:heatmap_rows].cpu().numpy()
+    cavex_corr = cavex_corr[:heatmap_rows].cpu().numpy()
 
     # org_corr = org_inv * org_inv
     # cvx_corr = cvx_inv * cvx_inv
@@ -136,13 +126,12 @@ def inner_products(original, cavex):
     # cvx_corr = cvx_norm * cvx_norm
 
     fig, axs = plt.subplots(2, 1)
-    length = len(original)
     original_df = pd.DataFrame(org_corr, range(len(org_corr)), range(len(org_corr[0])))
     axs[0] = sn.heatmap(original_df, annot=True, annot_kws={'size': 8}, ax=axs[0])
     axs[0].set_title("Original ")
     cavex_df = pd.DataFrame(cavex_corr, range(len(cavex_corr)), range(len(cavex_corr[0])))
     axs[1] = sn.heatmap(cavex_df, annot=True, annot_kws={'size': 8}, ax=axs[1])
-    axs[1].set_title("Testing confusion")
+    axs[1].set_title("Cavex")
     figure = plt.gcf()
     figure.set_size_inches(16, 9)
     plt.tight_layout(rect=[0, 0.3, 1, 0.95])
@@ -151,10 +140,15 @@ def inner_products(original, cavex):
     plt.show()
     plt.close()
 
-full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-full_cavex_c = torch.load('data/cavex_c {}.pt'.format(net_file))
-full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-full_cavex_der = torch.load('data/cavex_der {}.pt'.format(net_file))
+similarity_k = 10
+similarity_block = 512  # planes per side of every block of pairs
+heatmap_rows = 50
+
+planes = load_planes(net_file, device=device)
+full_sig_c = planes['sig_c']
+full_cavex_c = planes['cavex_c']
+full_sig_der = planes['sig_der']
+full_cavex_der = planes['cavex_der']
 
 inner_products(full_sig_der, full_cavex_der)
 
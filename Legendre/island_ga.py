@@ -0,0 +1,129 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+import torch
+from Legendre.plane_store import PlaneStore, store_path
+from Legendre.incremental_fitness import IncrementalFitness
+from Legendre.ga_operators import reproduce
+
+
+# Island model version of the LeGAendre.py GA. Every island is a CPU process evolving its own
+# sub-population. The islands open the same plane store read only, its memmapped files are
+# shared through the page cache so only the planes their genomes hold are ever read. Every
+# migration_interval generations each island sends copies of its best migrants genomes to the
+# next island in a ring, where they replace the worst agents. All islands score on the same
+# fixed evaluation set with IncrementalFitness so migrant fitnesses are comparable.
+
+default_config = {'generations': 100,
+                  'population_size': 100,
+                  'genome_length': 1000,
+                  'tournament_size': 4,
+                  'mutation_rate': 0.03,
+                  'elitism': 0.1,
+                  'migration_interval': 10,
+                  'migrants': 2,
+                  'threads': 1,
+                  'seed': 272727}
+
+
+def next_population(population, fitnesses, config, num_planes, rng):
+    num_elite = int(config['elitism'] * len(population))
+    elite_index = np.argsort(-fitnesses, kind='stable')[:num_elite]
+    children, parents = reproduce(population, fitnesses, len(population) - num_elite,
+                                  config['tournament_size'], config['mutation_rate'], num_planes, rng)
+    return torch.vstack([population[elite_index], children]), np.concatenate([elite_index, parents])
+
+
+def migrate(population, states, fitnesses, fitness, config, inbox, outbox):
+    best = np.argsort(-fitnesses, kind='stable')[:config['migrants']]
+    outbox.put(population[best].numpy())
+    incoming = torch.from_numpy(inbox.get())
+    worst = np.argsort(fitnesses, kind='stable')[:len(incoming)]
+    for agent, genome in zip(worst, incoming):
+        population[agent] = genome
+        states[agent] = fitness.full_state(population[agent])
+        fitnesses[agent] = fitness.fitness(states[agent])
+    return population, states, fitnesses
+
+
+def run_island(island, num_islands, path, eval_batches, config, inbox, outbox, results):
+    torch.set_default_tensor_type(torch.FloatTensor)
+    torch.set_num_threads(config['threads'])
+    rng = np.random.RandomState(config['seed'] + island)
+    store = PlaneStore(path)
+    num_planes = len(store)
+    fitness = IncrementalFitness(eval_batches, store['sig_der'], store['sig_c'], store['cavex_der'], store['cavex_c'])
+    population = torch.stack([torch.from_numpy(rng.choice(num_planes, config['genome_length'], replace=False))
+                              for i in range(config['population_size'])])
+    metrics = []
+    with torch.no_grad():
+        states = [fitness.full_state(agent) for agent in population]
+        for g in range(config['generations']):
+            fitnesses = np.array([fitness.fitness(state) for state in states])
+            if num_islands > 1 and config['migration_interval'] and g and not g % config['migration_interval']:
+                population, states, fitnesses = migrate(population, states, fitnesses, fitness, config,
+                                                        inbox, outbox)
+            metrics.append([float(np.max(fitnesses)), float(np.min(fitnesses)), float(np.mean(fitnesses))])
+            print("Island {} generation {}   max = {}   min = {}   average = {}   planes evaluated {}".format(
+                island, g, *metrics[-1], fitness.planes_evaluated))
+            if g == config['generations'] - 1:
+                break
+            parent_population = population
+            population, parents = next_population(population, fitnesses, config, num_planes, rng)
+            states = [fitness.child_state(states[parent], parent_population[parent], child)
+                      for parent, child in zip(parents, population)]
+    best = int(np.argmax(fitnesses))
+    results.put({'island': island,
+                 'metrics': metrics,
+                 'best_fitness': float(fitnesses[best]),
+                 'best_genome': population[best].numpy(),
+                 'planes_evaluated': fitness.planes_evaluated,
+                 'fallbacks': fitness.fallbacks})
+
+
+def island_ga(path, eval_batches, num_islands=4, metrics_dir=None, **config):
+    # eval_batches is a list of (images, labels) on the cpu, already shifted like the planes
+    config = dict(default_config, **config)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for island in range(num_islands)]
+    results = context.Queue()
+    # island i reads from queue i and sends to queue i + 1
+    islands = [context.Process(target=run_island,
+                               args=(island, num_islands, path, eval_batches, config,
+                                     queues[island], queues[(island + 1) % num_islands], results))
+               for island in range(num_islands)]
+    for process in islands:
+        process.start()
+    island_results = sorted([results.get() for island in islands], key=lambda result: result['island'])
+    for process in islands:
+        process.join()
+    if metrics_dir is not None:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for result in island_results:
+            with open(os.path.join(metrics_dir, 'island{}.json'.format(result['island'])), 'w') as metrics_file:
+                json.dump({'config': config, 'metrics': result['metrics'], 'best_fitness': result['best_fitness'],
+                           'best_genome': result['best_genome'].tolist()}, metrics_file)
+    return island_results
+
+
+if __name__ == '__main__':
+    from torchvision import transforms, datasets
+    torch.set_default_tensor_type(torch.FloatTensor)
+    net_file = 'mnist0.5 sigmoid hidden_size[200] test_acc[98.1]'
+    batch_n = 100
+    testset = datasets.MNIST('', download=True, train=False, transform=transforms.ToTensor())
+    generator = torch.Generator()
+    generator.manual_seed(272727)
+    test_loader = torch.utils.data.DataLoader(testset, batch_size=128, shuffle=True, generator=generator)
+    eval_batches = []
+    for batch, (images, labels) in enumerate(test_loader):
+        if batch >= batch_n:
+            break
+        eval_batches.append((images.reshape(-1, 784) - 0.5, labels))
+    num_islands = max(1, os.cpu_count() // 2)
+    island_results = island_ga(store_path(net_file), eval_batches, num_islands=num_islands,
+                               metrics_dir='./plots/islands {}'.format(net_file))
+    for result in island_results:
+        print("Island {} best {}".format(result['island'], result['best_fitness']))
+    print("Done")
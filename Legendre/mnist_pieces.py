@@ -14,6 +14,8 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_store import load_planes
+from Legendre import piecewise_engine
 
 sns.set_theme(style="whitegrid")
 
@@ -28,6 +30,8 @@ else:
 torch.manual_seed(272727)
 print("generating data")
 batch_size = 128
+memory_budget = 2 ** 30  # bytes of plane responses per piecewise_value call, None for all at once
+one_pass_sweep = True  # every sample amount from one pass over a permutation per repeat
 trainset = datasets.MNIST('', download=True, train=True, transform=transforms.ToTensor())
 testset = datasets.MNIST('', download=True, train=False, transform=transforms.ToTensor())
 train_loader = torch.utils.data.DataLoader(trainset, batch_size=batch_size,
@@ -68,28 +72,16 @@ def Der(x, w, b, out_w, der_type):
     return out
 
 def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft=False):
-    sy = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(sig_m, sig_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, sm)
-        cavexx = torch.matmul(x, cvm)
-        sy.append(smx + sc)
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    cavexy = torch.stack(cavexy)
-    max_vex_max = torch.max(cavexy, dim=0)[1]
-    min_cave_min = torch.min(-cavexy, dim=0)[1]
-    vex_sy = torch.stack([torch.stack(
-        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max)])
-    cave_sy = torch.stack([torch.stack(
-        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min)])
-    y = (vex_sy + cave_sy) / 2
-    return y
+    # mindex output, the winning cavex plane picks which sig plane is used
+    return piecewise_engine.piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c,
+                                            memory_budget=memory_budget)[1]
 
-full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-full_cavex_c = torch.load('data/cavex_c {}.pt'.format(net_file))
-full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-full_cavex_der = torch.load('data/cavex_der {}.pt'.format(net_file))
+plane_set = ''  # ' pruned' or ' greedy' for the compact plane sets from plane_pruning.py or greedy_selection.py
+planes = load_planes(net_file + plane_set, device=device)
+full_sig_c = planes['sig_c']
+full_cavex_c = planes['cavex_c']
+full_sig_der = planes['sig_der']
+full_cavex_der = planes['cavex_der']
 
 with torch.no_grad():
     correct_m = 0
@@ -106,38 +98,50 @@ with torch.no_grad():
 
     sample_intervals = 100
     repeats = 10
+    sample_amounts = np.linspace(1, number_of_legendre, sample_intervals, dtype=int)
     scores = {}
-    for l_amount in np.linspace(1, number_of_legendre, sample_intervals, dtype=int):
-        print("starting Legendre sample amount", l_amount)
-        amount_sample = []
-        for repeat in range(repeats):
-            correct_l = 0
-            total = 0
-            legendre_sample = np.random.choice(range(number_of_legendre), l_amount, replace=False)
-            for images, labels in tqdm(test_loader):
-                images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
-                out_l = piecewise_value(images,
-                                        full_sig_der[legendre_sample],
-                                        full_sig_c[legendre_sample],
-                                        full_cavex_der[legendre_sample],
-                                        full_cavex_c[legendre_sample])
-                _, pred = torch.max(out_l, 1)
-                correct_l += (pred == labels).sum().item()
-                total += labels.size(0)
-            test_accuracy = 100 * correct_l / total
-            print('Legendre testing accuracy: {} % for L_amount{} repeat{}'.format(
-                test_accuracy, l_amount, repeat))
-            amount_sample.append(test_accuracy)
-        scores['{}'.format(l_amount)] = amount_sample
-        for setting in scores:
-            print("Full scores for {} = {}".format(setting, scores[setting]))
-        print("Model test accuracy {}%".format(model_test_accuracy))
-        for setting in scores:
-            print("For amount", setting, "mean = {:.2F}    stdev = {:.2F}    min = {:.2F}    max = {:.2F}".format(
-                np.mean(scores[setting]),
-                np.std(scores[setting]),
-                np.min(scores[setting]),
-                np.max(scores[setting])))
+    if one_pass_sweep:
+        # nested random subsets, every amount of a repeat is a prefix of the same permutation
+        test_batches = [(images.reshape(-1, 784).to(torch.device(device)) - 0.5, labels.to(torch.device(device)))
+                        for images, labels in test_loader]
+        sweep = piecewise_engine.prefix_accuracy_sweep(test_batches, full_sig_der, full_sig_c, full_cavex_der,
+                                                       full_cavex_c, sample_amounts, repeats,
+                                                       memory_budget=memory_budget)
+        for l_amount, amount_sample in zip(sample_amounts, np.transpose(sweep)):
+            scores['{}'.format(l_amount)] = list(amount_sample)
+    else:
+        for l_amount in sample_amounts:
+            print("starting Legendre sample amount", l_amount)
+            amount_sample = []
+            for repeat in range(repeats):
+                correct_l = 0
+                total = 0
+                legendre_sample = np.random.choice(range(number_of_legendre), l_amount, replace=False)
+                # read the sampled planes once instead of once per batch
+                a, b, c, d = full_sig_der[legendre_sample], \
+                             full_sig_c[legendre_sample], \
+                             full_cavex_der[legendre_sample], \
+                             full_cavex_c[legendre_sample]
+                for images, labels in tqdm(test_loader):
+                    images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
+                    out_l = piecewise_value(images, a, b, c, d)
+                    _, pred = torch.max(out_l, 1)
+                    correct_l += (pred == labels).sum().item()
+                    total += labels.size(0)
+                test_accuracy = 100 * correct_l / total
+                print('Legendre testing accuracy: {} % for L_amount{} repeat{}'.format(
+                    test_accuracy, l_amount, repeat))
+                amount_sample.append(test_accuracy)
+            scores['{}'.format(l_amount)] = amount_sample
+            for setting in scores:
+                print("Full scores for {} = {}".format(setting, scores[setting]))
+    print("Model test accuracy {}%".format(model_test_accuracy))
+    for setting in scores:
+        print("For amount", setting, "mean = {:.2F}    stdev = {:.2F}    min = {:.2F}    max = {:.2F}".format(
+            np.mean(scores[setting]),
+            np.std(scores[setting]),
+            np.min(scores[setting]),
+            np.max(scores[setting])))
 
 print("Done")
 
@@ -14,6 +14,8 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_extraction import extract_sig_planes
+from Legendre.plane_store import ResumableExtraction, store_path
 
 sns.set_theme(style="whitegrid")
 
@@ -147,94 +149,42 @@ def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, old=False):
         y = (y_min + y_max) / 2
     return y
 
-full_sig = []
-full_cavex = []
-old_full_cavex = []
-full_sig_der = []
-full_cavex_der = []
-old_full_cavex_der = []
-full_sig_c = []
-full_cavex_c = []
-old_full_cavex_c = []
-
 legendre_scale_factor = 1#0e3
 
 hidden_size = model.layer[0].bias.shape[0]
+check_extraction = False
 
+# the old per input cavex planes are stored as cavex_der/cavex_c next to the x2_ ones, so split_mnist style
+# readers can open this store with load_planes(net_file, device=device, suffix=' x_squared')
+# rerunning after a crash carries on from the last checkpoint, a finished store is reused as is
+checkpoint_every = 50
+extraction = ResumableExtraction(store_path(net_file, suffix=' x_squared'), train_loader,
+                                 checkpoint_every=checkpoint_every, device=device, kind='x_squared',
+                                 names=('sig_der', 'sig_c', 'x2_cavex_der', 'x2_cavex_c', 'cavex_der', 'cavex_c'))
 
 print("extracting Legendre transform")
 
-for images, labels in tqdm(train_loader):
+for images, labels in tqdm(extraction.batches(), initial=extraction.done, total=len(train_loader)):
     images = images.reshape(-1, 784).to(torch.device(device)) - 0.5
-    for i, (w, b, out_w) in enumerate(zip(model.layer[0].weight.data,
-                                   model.layer[0].bias.data,
-                                   torch.transpose(model.layer[1].weight.data, 0, 1)
-                                   )):
-
-        w = w.type(default_type)
-        b = b.type(default_type)
-        out_w = out_w.type(default_type)
-
-        neuron_sig = Sig(images, w, b, out_w)
-        neuron_cavex = CaVexSig(images, w, out_w)
-        old_neuron_cavex = CaVexSig(images, w, out_w, old=True)
-        neuron_sig_der = Der(images, w, b, out_w, 'sig')
-        neuron_cavex_der = Der(images, w, b, out_w, False)
-        old_neuron_cavex_der = Der(images, w, b, out_w, False, old=True)
-
-        for output, ow in enumerate(out_w):
-            if ow < 0:
-                neuron_cavex[:, output] *= -1
-                neuron_cavex_der[:, :, output] *= -1
-                old_neuron_cavex[:, output] *= -1
-                old_neuron_cavex_der[:, :, output] *= -1
-
-        if not i:
-            full_sig.append(neuron_sig)
-            full_cavex.append(neuron_cavex)
-            old_full_cavex.append(old_neuron_cavex)
-            full_sig_der.append(neuron_sig_der)
-            full_cavex_der.append(neuron_cavex_der)
-            old_full_cavex_der.append(old_neuron_cavex_der)
-        else:
-            full_sig[-1] += neuron_sig
-            full_cavex[-1] += neuron_cavex
-            old_full_cavex[-1] += old_neuron_cavex
-            full_sig_der[-1] += neuron_sig_der
-            full_cavex_der[-1] += neuron_cavex_der
-            old_full_cavex_der[-1] += old_neuron_cavex_der
-
-    full_sig_c.append(full_sig[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(full_sig_der[-1], images)]))
-    full_cavex_c.append(full_cavex[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(full_cavex_der[-1], images)]))
-    old_full_cavex_c.append(old_full_cavex[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(old_full_cavex_der[-1], images)]))
-    print('', end='')
-
-full_sig_c = torch.vstack(full_sig_c)
-full_cavex_c = torch.vstack(full_cavex_c)
-old_full_cavex_c = torch.vstack(old_full_cavex_c)
-full_sig_der = torch.vstack(full_sig_der)
-full_cavex_der = torch.vstack(full_cavex_der)
-old_full_cavex_der = torch.vstack(old_full_cavex_der)
-
-print('', end='')
-
+    sig_der, sig_c, cavex_der, cavex_c = extract_sig_planes(images, model, x_squared=True,
+                                                            check=check_extraction)
+    _, _, old_cavex_der, old_cavex_c = extract_sig_planes(images, model, check=check_extraction)
+    extraction.append(sig_der=sig_der, sig_c=sig_c,
+                      x2_cavex_der=cavex_der, x2_cavex_c=cavex_c,
+                      cavex_der=old_cavex_der, cavex_c=old_cavex_c)
+store = extraction.finish()
 
-torch.save(full_sig_c, 'data/sig_c {}.pt'.format(net_file))
-torch.save(full_sig_der, 'data/sig_der {}.pt'.format(net_file))
-torch.save(full_cavex_c, 'data/x2_cavex_c {}.pt'.format(net_file))
-torch.save(full_cavex_der, 'data/x2_cavex_der {}.pt'.format(net_file))
-torch.save(old_full_cavex_c, 'data/old_cavex_c {}.pt'.format(net_file))
-torch.save(old_full_cavex_der, 'data/old_cavex_der {}.pt'.format(net_file))
 # print("Loading data")
-# full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-# full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-# full_cavex_c = torch.load('data/x2_cavex_c {}.pt'.format(net_file))
-# full_cavex_der = torch.load('data/x2_cavex_der {}.pt'.format(net_file))
-# old_full_cavex_c = torch.load('data/old_cavex_c {}.pt'.format(net_file))
-# old_full_cavex_der = torch.load('data/old_cavex_der {}.pt'.format(net_file))
+# store = PlaneStore(store_path(net_file, suffix=' x_squared'), device=device)
+full_sig_c = store['sig_c']
+full_sig_der = store['sig_der']
+full_cavex_c = store['x2_cavex_c']
+full_cavex_der = store['x2_cavex_der']
+old_full_cavex_c = store['cavex_c']
+old_full_cavex_der = store['cavex_der']
+# every batch uses the full plane sets four times so they are read into memory once
+full_sig_c, full_sig_der, full_cavex_c, full_cavex_der, old_full_cavex_c, old_full_cavex_der = [
+    p[:] for p in [full_sig_c, full_sig_der, full_cavex_c, full_cavex_der, old_full_cavex_c, old_full_cavex_der]]
 
 with torch.no_grad():
     correct_m = 0
@@ -0,0 +1,343 @@
+import time
+import numpy as np
+import torch
+from Legendre.implicit_planes import FactorizedSigPlanes, AnchorCavexPlanes
+
+
+# Loop free evaluation of the Legendre planes. Planes come in two layouts:
+#   plane first (split_mnist.py, mnist_pieces.py, LeGAendre.py): sig_m [L, in, out], sig_c [L, out]
+#   output first (hessian_mnist.py, hessian_2D.py, reverse_2D.py): net_m [out, L, in], net_c [out, L]
+# Either way the responses are returned as [L, B, out] views so reductions run over dim 0.
+# sig_m may also be FactorizedSigPlanes and cavex_m AnchorCavexPlanes, their c is then ignored.
+
+def as_tensor(planes):
+    # plane store arrays are read in full, tensors pass straight through
+    if isinstance(planes, torch.Tensor):
+        return planes
+    return planes[:]
+
+
+def plane_response(x, m, c, output_first=False):
+    if isinstance(m, FactorizedSigPlanes):
+        return m.response(x)
+    if isinstance(m, AnchorCavexPlanes):
+        return m.response(x).permute(2, 1, 0)
+    m = as_tensor(m)
+    c = as_tensor(c)
+    if output_first:
+        return (torch.matmul(x, torch.transpose(m, 1, 2)) + c.unsqueeze(1)).permute(2, 1, 0)
+    return torch.matmul(x, m) + c.unsqueeze(1)
+
+
+def plane_responses(x, sig_m, sig_c, cavex_m, cavex_c, output_first=False):
+    sy = plane_response(x, sig_m, sig_c, output_first)
+    cavexy = plane_response(x, cavex_m, cavex_c, output_first)
+    return sy, cavexy
+
+
+def gather_planes(values, index):
+    # values[index[b, k], b, k] for every sample and output
+    return torch.gather(values, 0, index.unsqueeze(0)).squeeze(0)
+
+
+def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, output_first=False, memory_budget=None):
+    if memory_budget is not None:
+        return streaming_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, output_first, memory_budget)
+    sy, cavexy = plane_responses(x, sig_m, sig_c, cavex_m, cavex_c, output_first)
+    y_max = torch.max(sy + cavexy, dim=0)[0]
+    y_min = torch.min(sy - cavexy, dim=0)[0]
+    # the old code also took min(-cavexy) for the cave side, that is the same plane so one gather does
+    max_vex_max = torch.max(cavexy, dim=0)[1]
+    mindex_y = gather_planes(sy, max_vex_max)
+    return (y_min + y_max) / 2, mindex_y
+
+
+def selected_response(x, sig_m, sig_c, winners, output_first=False):
+    # response of only the winning sig plane of every sample, [B, out]
+    if isinstance(sig_m, FactorizedSigPlanes):
+        planes = sig_m[winners]
+        hidden = torch.matmul(x, torch.transpose(planes.w, 0, 1))
+        return torch.matmul(hidden * planes.hidden_der, torch.transpose(planes.out_w, 0, 1)) + planes.sig_c
+    if output_first:
+        return torch.transpose(torch.sum(x * sig_m[:, winners], dim=2) + sig_c[:, winners], 0, 1)
+    return torch.sum(x.unsqueeze(2) * sig_m[winners], dim=1) + sig_c[winners]
+
+
+# mindex output with the cavex winner found by a nearest anchor index (anchor_index.py)
+# instead of evaluating every cavex plane, only valid for positive cavex constants
+def indexed_piecewise_value(x, sig_m, sig_c, cavex_index, output_first=False):
+    winners = cavex_index.search(x)
+    return selected_response(x, sig_m, sig_c, winners, output_first)
+
+
+# Soft envelope, the sig planes weighted by softmax(cavexy / t) over the planes, for every
+# temperature t at once, [T, B, out]. The softmax is computed online over chunks of planes: a
+# running max of cavexy and, per temperature, running sums of the weights and of the weighted
+# sig responses that are rescaled whenever the max grows, so no exp overflows at small t.
+def soft_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, temperatures, output_first=False,
+                         memory_budget=2 ** 28):
+    num_planes = plane_count(sig_m, output_first)
+    num_outputs = output_count(sig_m, sig_c, output_first)
+    temperatures = torch.tensor(temperatures, dtype=x.dtype, device=x.device).reshape(-1, 1, 1, 1)
+    # sy, cavexy and the [T] weights and weighted responses of every plane
+    plane_bytes = x.element_size() * ((2 + 2 * len(temperatures)) * len(x) * num_outputs + 2 * x.shape[1] * num_outputs)
+    chunk = max(1, int(memory_budget // plane_bytes))
+    running_max = None
+    for start in range(0, num_planes, chunk):
+        end = min(start + chunk, num_planes)
+        sy, cavexy = plane_responses(x,
+                                     plane_slice(sig_m, start, end, output_first),
+                                     plane_slice(sig_c, start, end, output_first),
+                                     plane_slice(cavex_m, start, end, output_first),
+                                     plane_slice(cavex_c, start, end, output_first),
+                                     output_first)
+        chunk_max = torch.max(cavexy, dim=0)[0]
+        if running_max is None:
+            running_max = chunk_max
+            weight_sum = torch.zeros((len(temperatures),) + chunk_max.shape, dtype=x.dtype, device=x.device)
+            weighted_sum = torch.zeros_like(weight_sum)
+        else:
+            new_max = torch.maximum(running_max, chunk_max)
+            rescale = torch.exp((running_max - new_max) / temperatures.squeeze(1))
+            weight_sum = weight_sum * rescale
+            weighted_sum = weighted_sum * rescale
+            running_max = new_max
+        weights = torch.exp((cavexy - running_max) / temperatures)
+        weight_sum = weight_sum + torch.sum(weights, dim=1)
+        weighted_sum = weighted_sum + torch.sum(weights * sy, dim=1)
+    return weighted_sum / weight_sum
+
+
+def population_value(sy, cavexy, population, memory_budget=2 ** 28):
+    # mindex output of every agent, [P, B, out]. Agents are rows of plane indices into the shared
+    # [L, B, out] responses, the winning cavex plane is found for all agents of a chunk at once.
+    population = population.to(sy.device)
+    agent_bytes = population.shape[1] * cavexy.shape[1] * cavexy.shape[2] * cavexy.element_size()
+    chunk = max(1, int(memory_budget // agent_bytes))
+    batch_index = torch.arange(sy.shape[1], device=sy.device).unsqueeze(1)
+    out_index = torch.arange(sy.shape[2], device=sy.device)
+    values = []
+    for start in range(0, len(population), chunk):
+        agents = population[start:start + chunk]
+        winner = torch.max(cavexy[agents], dim=1)[1]
+        planes = torch.gather(agents, 1, winner.reshape(len(agents), -1)).reshape(winner.shape)
+        values.append(sy[planes, batch_index, out_index])
+    return torch.vstack(values)
+
+
+def population_correct(vexy, cavey, population, labels, memory_budget=2 ** 28):
+    # correct predictions of every agent's envelope output, [P], counted on the device. vexy and
+    # cavey are the [L, B, out] vex and cave responses, agents are rows of plane indices into them
+    population = population.to(vexy.device)
+    labels = labels.to(vexy.device)
+    agent_bytes = 2 * population.shape[1] * vexy.shape[1] * vexy.shape[2] * vexy.element_size()
+    chunk = max(1, int(memory_budget // agent_bytes))
+    correct = []
+    for start in range(0, len(population), chunk):
+        agents = population[start:start + chunk]
+        y = (torch.max(vexy[agents], dim=1)[0] + torch.min(cavey[agents], dim=1)[0]) / 2
+        correct.append(torch.sum(torch.max(y, dim=2)[1] == labels, dim=1))
+    return torch.cat(correct)
+
+
+def plane_count(m, output_first=False):
+    if output_first and not isinstance(m, (FactorizedSigPlanes, AnchorCavexPlanes)):
+        return m.shape[1]
+    return len(m)
+
+
+def output_count(sig_m, sig_c, output_first=False):
+    if isinstance(sig_m, FactorizedSigPlanes):
+        return sig_m.out_w.shape[0]
+    if output_first:
+        return sig_c.shape[0]
+    return sig_c.shape[1]
+
+
+def plane_slice(planes, start, end, output_first=False):
+    if planes is None:
+        return None
+    if output_first and not isinstance(planes, (FactorizedSigPlanes, AnchorCavexPlanes)):
+        return planes[:, start:end]
+    return planes[start:end]
+
+
+def planes_per_chunk(x, num_outputs, memory_budget):
+    # the sy and cavexy responses, their sum/difference temporaries and a dense sig + cavex plane
+    plane_bytes = x.element_size() * (4 * len(x) * num_outputs + 2 * x.shape[1] * num_outputs)
+    return max(1, int(memory_budget // plane_bytes))
+
+
+# Walks the planes in blocks that fit in memory_budget bytes, keeping the running max/min of the
+# envelope and the running winner of the cavex planes, so [L, B, out] is never held at once.
+# Gives the same outputs as piecewise_value, ties go to the earliest plane like torch.max does.
+def streaming_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, output_first=False,
+                              memory_budget=2 ** 28, return_index=False):
+    num_planes = plane_count(sig_m, output_first)
+    chunk = planes_per_chunk(x, output_count(sig_m, sig_c, output_first), memory_budget)
+    y_max = None
+    for start in range(0, num_planes, chunk):
+        end = min(start + chunk, num_planes)
+        sy, cavexy = plane_responses(x,
+                                     plane_slice(sig_m, start, end, output_first),
+                                     plane_slice(sig_c, start, end, output_first),
+                                     plane_slice(cavex_m, start, end, output_first),
+                                     plane_slice(cavex_c, start, end, output_first),
+                                     output_first)
+        chunk_max = torch.max(sy + cavexy, dim=0)[0]
+        chunk_min = torch.min(sy - cavexy, dim=0)[0]
+        chunk_best, chunk_index = torch.max(cavexy, dim=0)
+        chunk_mindex = gather_planes(sy, chunk_index)
+        if y_max is None:
+            y_max, y_min, best_cavex, mindex_y = chunk_max, chunk_min, chunk_best, chunk_mindex
+            best_index = chunk_index
+            continue
+        y_max = torch.maximum(y_max, chunk_max)
+        y_min = torch.minimum(y_min, chunk_min)
+        better = chunk_best > best_cavex
+        best_cavex = torch.where(better, chunk_best, best_cavex)
+        mindex_y = torch.where(better, chunk_mindex, mindex_y)
+        best_index = torch.where(better, chunk_index + start, best_index)
+    if return_index:
+        return (y_min + y_max) / 2, mindex_y, best_index
+    return (y_min + y_max) / 2, mindex_y
+
+
+def first_cummax(values):
+    # torch.cummax along dim 0 but ties go to the earliest index like torch.max, where cummax
+    # itself returns the latest. The earliest winner of a prefix is its last strict new record.
+    running = torch.cummax(values, dim=0)[0]
+    previous = torch.cat([torch.full_like(running[:1], -float('inf')), running[:-1]])
+    positions = torch.arange(len(values), device=values.device).reshape(-1, *([1] * (values.dim() - 1)))
+    records = torch.where(values > previous, positions, -1)
+    return running, torch.cummax(records, dim=0)[0]
+
+
+# Accuracy of the mindex output for every prefix of a plane order in one pass. The planes are
+# read in order in chunks and the cavex responses of each chunk go through a cummax, so the
+# winner of the first n planes is the running winner at position n. Tied cavex responses go to
+# the earliest plane in order, the same plane torch.max picks in piecewise_value. batches is a list of
+# (x, labels), the running winner of every batch is kept between chunks so each plane is read
+# once. Returns the number of correct predictions for every prefix size, [len(prefix_sizes)].
+def prefix_correct(batches, sig_m, sig_c, cavex_m, cavex_c, order, prefix_sizes, memory_budget=2 ** 28):
+    prefix_sizes = np.asarray(prefix_sizes)
+    num_planes = int(np.max(prefix_sizes))
+    x = max([x for x, labels in batches], key=len)
+    if memory_budget is None:
+        chunk = num_planes
+    else:
+        chunk = planes_per_chunk(x, output_count(sig_m, sig_c), memory_budget)
+    correct = torch.zeros(len(prefix_sizes), dtype=torch.long, device=x.device)
+    best_cavex = [None for batch in batches]
+    mindex_y = [None for batch in batches]
+    for start in range(0, num_planes, chunk):
+        end = min(start + chunk, num_planes)
+        planes = order[start:end]
+        chunk_planes = [m[planes] for m in [sig_m, sig_c, cavex_m, cavex_c]]
+        ends_here = [(i, int(n)) for i, n in enumerate(prefix_sizes) if start < n <= end]
+        for batch, (x, labels) in enumerate(batches):
+            sy, cavexy = plane_responses(x, *chunk_planes)
+            running_cavex, running_index = first_cummax(cavexy)
+            for i, n in ends_here:
+                prefix_y = gather_planes(sy, running_index[n - 1 - start])
+                if best_cavex[batch] is not None:
+                    better = running_cavex[n - 1 - start] > best_cavex[batch]
+                    prefix_y = torch.where(better, prefix_y, mindex_y[batch])
+                correct[i] += torch.sum(torch.max(prefix_y, 1)[1] == labels)
+            chunk_best = running_cavex[-1]
+            chunk_y = gather_planes(sy, running_index[-1])
+            if best_cavex[batch] is None:
+                best_cavex[batch], mindex_y[batch] = chunk_best, chunk_y
+                continue
+            better = chunk_best > best_cavex[batch]
+            best_cavex[batch] = torch.where(better, chunk_best, best_cavex[batch])
+            mindex_y[batch] = torch.where(better, chunk_y, mindex_y[batch])
+    return correct.cpu().numpy()
+
+
+def prefix_accuracy_sweep(batches, sig_m, sig_c, cavex_m, cavex_c, prefix_sizes, repeats, memory_budget=2 ** 28,
+                          rng=np.random):
+    # testing accuracy in % of a random subset of every size, [repeats, len(prefix_sizes)]. Each
+    # repeat draws one permutation, the subsets of one repeat are nested prefixes of it.
+    total = sum([len(labels) for x, labels in batches])
+    accuracies = []
+    for repeat in range(repeats):
+        order = rng.permutation(plane_count(sig_m))
+        accuracies.append(100 * prefix_correct(batches, sig_m, sig_c, cavex_m, cavex_c, order, prefix_sizes,
+                                               memory_budget) / total)
+    return np.array(accuracies)
+
+
+# The stacked per plane loop from hessian_mnist.py, kept to check and time the fused version
+def loop_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c):
+    sy = []
+    vexy = []
+    cavey = []
+    cavexy = []
+    for sm, sc, cvm, cvc in zip(sig_m, sig_c, cavex_m, cavex_c):
+        smx = torch.matmul(x, sm)
+        vexx = torch.matmul(x, sm + cvm)
+        cavex = torch.matmul(x, sm - cvm)
+        cavexx = torch.matmul(x, cvm)
+        sy.append((smx + sc))
+        vexy.append((vexx + cvc + sc))
+        cavey.append((cavex - cvc + sc))
+        cavexy.append(cavexx + cvc)
+    sy = torch.stack(sy)
+    vexy = torch.stack(vexy)
+    cavey = torch.stack(cavey)
+    cavexy = torch.stack(cavexy)
+    y_max = torch.max(vexy, dim=0)[0]
+    y_min = torch.min(cavey, dim=0)[0]
+    max_vex_max = torch.max(cavexy, dim=0)[1]
+    min_cave_min = torch.min(-cavexy, dim=0)[1]
+    vex_sy = torch.stack([torch.stack(
+        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max)])
+    cave_sy = torch.stack([torch.stack(
+        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min)])
+    return (y_min + y_max) / 2, (vex_sy + cave_sy) / 2
+
+
+def time_call(function, repeats):
+    function()
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def benchmark_piecewise(x, sig_m, sig_c, cavex_m, cavex_c, repeats=5, memory_budget=2 ** 24):
+    with torch.no_grad():
+        fused = piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c)
+        looped = loop_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c)
+        streamed = streaming_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, memory_budget=memory_budget)
+        fused_time = time_call(lambda: piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c), repeats)
+        loop_time = time_call(lambda: loop_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c), repeats)
+        streaming_time = time_call(lambda: streaming_piecewise_value(
+            x, sig_m, sig_c, cavex_m, cavex_c, memory_budget=memory_budget), repeats)
+    return {'planes': len(sig_m),
+            'batch': len(x),
+            'loop_time': loop_time,
+            'fused_time': fused_time,
+            'streaming_time': streaming_time,
+            'speedup': loop_time / fused_time,
+            'envelope_difference': torch.max(torch.abs(fused[0] - looped[0])).item(),
+            'mindex_difference': torch.max(torch.abs(fused[1] - looped[1])).item(),
+            'streaming_identical': bool(torch.equal(fused[0], streamed[0]) and torch.equal(fused[1], streamed[1]))}
+
+
+if __name__ == '__main__':
+    torch.manual_seed(272727)
+    input_size = 784
+    num_outputs = 10
+    batch_size = 128
+    for planes in [100, 1000, 5000]:
+        x = torch.rand(batch_size, input_size) - 0.5
+        sig_m = torch.randn(planes, input_size, num_outputs) * 0.01
+        sig_c = torch.randn(planes, num_outputs)
+        anchors = torch.rand(planes, input_size) - 0.5
+        cavex_c = -0.5 * torch.sum(anchors * anchors, dim=1).unsqueeze(1) * torch.ones(num_outputs)
+        cavex_m = anchors.unsqueeze(2) * torch.ones(num_outputs)
+        print(benchmark_piecewise(x, sig_m, sig_c, cavex_m, cavex_c))
@@ -0,0 +1,189 @@
+import torch
+from Legendre.hessian_bound import functional_forward
+
+
+# Batched Legendre plane extraction for the single hidden layer sigmoid nets.
+# Produces the same sig_der [B, in, out], sig_c [B, out], cavex_der [B, in, out]
+# and cavex_c [B, out] tensors as the per neuron Sig/CaVexSig/Der loops in
+# split_mnist.py, mnist_x_squared.py and split_sig_2D.py, but for all neurons at
+# once. Any net with non sigmoid hidden neurons is refused.
+
+def hidden_activation(images, model):
+    w = model.layer[0].weight.data.type(images.dtype)
+    b = model.layer[0].bias.data.type(images.dtype)
+    return torch.matmul(images, torch.transpose(w, 0, 1)) + b
+
+
+def cavex_weights(model, cavex_scale=0.05, x_squared=False, dtype=torch.float32):
+    w = model.layer[0].weight.data.type(dtype)
+    # flipping the cavex sign for negative output weights is the same as using |out_w|
+    out_w = torch.abs(model.layer[1].weight.data.type(dtype))
+    if x_squared:
+        # xTx version from mnist_x_squared.py, one constant per output
+        return torch.matmul(out_w, torch.sum(torch.square(w), dim=1)) * cavex_scale
+    return torch.matmul(torch.transpose(torch.square(w), 0, 1), torch.transpose(out_w, 0, 1)) * cavex_scale
+
+
+def check_sigmoid(model):
+    # sig_der uses s(1 - s) and the cavex constant bounds the sigmoid's curvature, neither holds for other neurons
+    neuron_types = sorted(set([str(n_type) for n_type in model.splits[0]]))
+    if neuron_types != ['sig']:
+        raise ValueError("sigmoid planes need a sigmoid net, this one has {} hidden neurons".format(neuron_types))
+
+
+def extract_sig_planes(images, model, cavex_scale=0.05, x_squared=False, check=False, atol=1e-5):
+    check_sigmoid(model)
+    w = model.layer[0].weight.data.type(images.dtype)
+    out_w = model.layer[1].weight.data.type(images.dtype)
+
+    sig = torch.sigmoid(hidden_activation(images, model))
+    sig_out = torch.matmul(sig, torch.transpose(out_w, 0, 1))
+    # W^T diag(s'(x)) out_w^T for every sample, [B, in, out]
+    scaled_der = (sig * (1 - sig)).unsqueeze(2) * torch.transpose(out_w, 0, 1)
+    sig_der = torch.matmul(torch.transpose(w, 0, 1), scaled_der)
+    sig_c = sig_out - torch.sum(images.unsqueeze(2) * sig_der, dim=1)
+
+    c = cavex_weights(model, cavex_scale, x_squared, dtype=images.dtype)
+    if x_squared:
+        cavex_out = torch.sum(images * images, dim=1).unsqueeze(1) * c
+    else:
+        cavex_out = torch.matmul(torch.square(images), c)
+    cavex_der = 2 * images.unsqueeze(2) * c
+    cavex_c = cavex_out - torch.sum(images.unsqueeze(2) * cavex_der, dim=1)
+
+    if check:
+        check_sig_planes(images, model, [sig_der, sig_c, cavex_der, cavex_c],
+                         cavex_scale=cavex_scale, x_squared=x_squared, atol=atol)
+
+    return sig_der, sig_c, cavex_der, cavex_c
+
+
+# The per neuron helpers exactly as they are in mnist_x_squared.py (old=True being the split_mnist.py
+# versions) and the split_mnist.py loop over them, kept as the reference for check=True
+def Sig(x, w, b, out_w):
+    out = out_w.unsqueeze(1) / (1 + torch.exp(-torch.sum(x * w, dim=1) - b))
+    return torch.transpose(out, 0, 1)
+
+
+def CaVexSig(x, w, out_w, old=False):
+    if old:
+        c = torch.matmul(torch.square(w).unsqueeze(1) * 0.05, out_w.unsqueeze(0))
+        out = torch.matmul(torch.square(x), c)
+    else:
+        c = (torch.matmul(w.unsqueeze(0), w.unsqueeze(1)) * out_w) * 0.05
+        x_squared = torch.matmul(torch.transpose(x.unsqueeze(2), 1, 2), x.unsqueeze(2)).squeeze()
+        out = x_squared.unsqueeze(1) * c
+    return out
+
+
+def Der(x, w, b, out_w, der_type, old=False):
+    # c = torch.square(w) * 0.5 * out_w
+    if der_type == 'sig':
+        sig = 1 / (1 + torch.exp(-torch.sum(x * w, dim=1) - b))
+        w_scale = torch.matmul(w.unsqueeze(1), out_w.unsqueeze(0))
+        sig_derivative = (sig * (1 - sig))
+        out = torch.stack([w_scale * der for der in sig_derivative])
+    else:
+        if old:
+            c = torch.matmul(torch.square(w).unsqueeze(1) * 0.05, out_w.unsqueeze(0))
+        else:
+            c = (torch.matmul(w.unsqueeze(0), w.unsqueeze(1)) * out_w) * 0.05
+        input_const = (2 * torch.stack([position.unsqueeze(1) * c for position in x]))
+        out = input_const
+    # full_out = torch.matmul(out.unsqueeze(2), out_w.unsqueeze(0))
+    return out
+
+
+def loop_sig_planes(images, model, cavex_scale=0.05, x_squared=False):
+    old = not x_squared
+    full_sig = []
+    full_cavex = []
+    full_sig_der = []
+    full_cavex_der = []
+    for i, (w, b, out_w) in enumerate(zip(model.layer[0].weight.data.type(images.dtype),
+                                          model.layer[0].bias.data.type(images.dtype),
+                                          torch.transpose(model.layer[1].weight.data.type(images.dtype), 0, 1)
+                                          )):
+
+        neuron_sig = Sig(images, w, b, out_w)
+        neuron_cavex = CaVexSig(images, w, out_w, old)
+        neuron_sig_der = Der(images, w, b, out_w, 'sig', old)
+        neuron_cavex_der = Der(images, w, b, out_w, False, old)
+
+        for output, ow in enumerate(out_w):
+            if ow < 0:
+                neuron_cavex[:, output] *= -1
+                neuron_cavex_der[:, :, output] *= -1
+
+        if not i:
+            full_sig.append(neuron_sig)
+            full_cavex.append(neuron_cavex)
+            full_sig_der.append(neuron_sig_der)
+            full_cavex_der.append(neuron_cavex_der)
+        else:
+            full_sig[-1] += neuron_sig
+            full_cavex[-1] += neuron_cavex
+            full_sig_der[-1] += neuron_sig_der
+            full_cavex_der[-1] += neuron_cavex_der
+
+    full_sig_c = full_sig[-1] - torch.stack(
+        [torch.matmul(im, f) for f, im in zip(full_sig_der[-1], images)])
+    full_cavex_c = full_cavex[-1] - torch.stack(
+        [torch.matmul(im, f) for f, im in zip(full_cavex_der[-1], images)])
+    # the helpers hard code a cavex scale of 0.05, the cavex planes are linear in it
+    scale = cavex_scale / 0.05
+    return full_sig_der[-1], full_sig_c, full_cavex_der[-1] * scale, full_cavex_c * scale
+
+
+def check_sig_planes(images, model, planes, cavex_scale=0.05, x_squared=False, atol=1e-5):
+    reference = loop_sig_planes(images, model, cavex_scale, x_squared)
+    for name, batched, looped in zip(['sig_der', 'sig_c', 'cavex_der', 'cavex_c'], planes, reference):
+        difference = torch.max(torch.abs(batched - looped)).item()
+        scale = max(torch.max(torch.abs(looped)).item(), 1)
+        if difference > atol * scale:
+            raise ValueError("batched {} differs from the neuron loop by {}".format(name, difference))
+
+
+# Gradient planes of every output of any NeuralNet (any hidden_size list) for
+# hessian_mnist.py, hessian_2D.py and reverse_2D.py. One vmapped jacrev gives all
+# outputs from a single forward instead of a forward and backward per output.
+# Returns net_out [out, B], net_m [out, B, in] and net_c [out, B].
+def output_planes(images, model, check=False, atol=1e-5):
+    def single(sample):
+        out = functional_forward(model, sample.unsqueeze(0)).squeeze(0)
+        return out, out
+    images = images.detach()
+    jacobian, out = torch.func.vmap(torch.func.jacrev(single, has_aux=True))(images)
+    net_m = jacobian.permute(1, 0, 2).detach()
+    net_out = torch.transpose(out, 0, 1).detach()
+    net_c = net_out - torch.sum(net_m * images, dim=2)
+    if check:
+        check_output_planes(images, model, [net_out, net_m, net_c], atol)
+    return net_out, net_m, net_c
+
+
+# The backward per output loop the scripts used, kept as the reference for check=True
+def loop_output_planes(images, model):
+    images = images.detach().clone()
+    images.requires_grad = True
+    n_out = []
+    n_m = []
+    for out in range(model.layer[-1].weight.shape[0]):
+        n_out.append(model.separate_outputs(out)(images))
+        n_out[-1].backward(torch.ones(images.shape[0]))
+        n_m.append(images.grad.clone().detach())
+        images.grad = None
+    images.requires_grad = False
+    with torch.no_grad():
+        net_out = torch.stack([out.detach() for out in n_out])
+        net_m = torch.stack(n_m)
+        return net_out, net_m, net_out - torch.sum(net_m * images, dim=2)
+
+
+def check_output_planes(images, model, planes, atol=1e-5):
+    reference = loop_output_planes(images, model)
+    for name, batched, looped in zip(['net_out', 'net_m', 'net_c'], planes, reference):
+        difference = torch.max(torch.abs(batched - looped)).item()
+        scale = max(torch.max(torch.abs(looped)).item(), 1)
+        if difference > atol * scale:
+            raise ValueError("batched {} differs from the output loop by {}".format(name, difference))
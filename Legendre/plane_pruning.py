@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+from Legendre import piecewise_engine
+from Legendre.plane_store import PlaneStore, store_path, load_planes
+
+
+# Most planes never win the mindex selection for a real input. The winning cavex plane of every
+# sample and output of a validation stream is found with the planes read once in chunks, and
+# bincount turns the winners into a win count per plane. Planes are then ranked by wins and the
+# shortest ranking prefix whose accuracy is within tolerance of the full set is kept, those
+# planes (with their original indices) are written out as a compact plane store.
+
+plane_names = ['sig_der', 'sig_c', 'cavex_der', 'cavex_c']
+
+
+def cavex_winners(batches, cavex_m, cavex_c, memory_budget=2 ** 28):
+    # index of the winning cavex plane for every sample and output of batches, [N, out]
+    num_planes = len(cavex_c)
+    x = max([x for x, labels in batches], key=len)
+    chunk = piecewise_engine.planes_per_chunk(x, cavex_c.shape[1], memory_budget)
+    best_cavex = [None for batch in batches]
+    best_index = [None for batch in batches]
+    for start in range(0, num_planes, chunk):
+        end = min(start + chunk, num_planes)
+        chunk_m, chunk_c = cavex_m[start:end], cavex_c[start:end]
+        for batch, (x, labels) in enumerate(batches):
+            chunk_best, chunk_index = torch.max(piecewise_engine.plane_response(x, chunk_m, chunk_c), dim=0)
+            if best_cavex[batch] is None:
+                best_cavex[batch], best_index[batch] = chunk_best, chunk_index
+                continue
+            better = chunk_best > best_cavex[batch]
+            best_cavex[batch] = torch.where(better, chunk_best, best_cavex[batch])
+            best_index[batch] = torch.where(better, chunk_index + start, best_index[batch])
+    return torch.vstack(best_index)
+
+
+def win_counts(batches, cavex_m, cavex_c, memory_budget=2 ** 28):
+    winners = cavex_winners(batches, cavex_m, cavex_c, memory_budget)
+    return torch.bincount(winners.flatten(), minlength=len(cavex_c)).cpu().numpy()
+
+
+def prune_planes(batches, planes, tolerance=0.1, check_batches=None, sizes=50, memory_budget=2 ** 28):
+    # planes is a dict of plane first arrays (tensors or a PlaneStore). Returns the sorted
+    # indices of the planes to keep, the win counts and a report. Accuracy is checked on
+    # check_batches, the validation stream itself if None, at sizes ranking prefixes spread
+    # geometrically up to the number of planes that won at least once, plus the full set.
+    if check_batches is None:
+        check_batches = batches
+    counts = win_counts(batches, planes['cavex_der'], planes['cavex_c'], memory_budget)
+    num_planes = len(counts)
+    winners = int(np.sum(counts > 0))
+    # most wins first, ties by index
+    order = np.argsort(-counts, kind='stable')
+    prefix_sizes = np.unique(np.geomspace(1, max(winners, 1), sizes).astype(int))
+    prefix_sizes = np.append(prefix_sizes, num_planes)
+    total = sum([len(labels) for x, labels in check_batches])
+    accuracies = 100 * piecewise_engine.prefix_correct(check_batches, planes['sig_der'], planes['sig_c'],
+                                                       planes['cavex_der'], planes['cavex_c'], order,
+                                                       prefix_sizes, memory_budget) / total
+    full_accuracy = accuracies[-1]
+    keep_size = int(prefix_sizes[np.argmax(accuracies >= full_accuracy - tolerance)])
+    keep = np.sort(order[:keep_size])
+    report = {'planes': num_planes,
+              'winners': winners,
+              'kept': keep_size,
+              'full_accuracy': float(full_accuracy),
+              'kept_accuracy': float(accuracies[np.argmax(accuracies >= full_accuracy - tolerance)]),
+              'tolerance': tolerance,
+              'curve': [[int(size), float(accuracy)] for size, accuracy in zip(prefix_sizes, accuracies)]}
+    return keep, counts, report
+
+
+def write_planes(planes, keep, path, counts=None, report=None, chunk=1024):
+    # the kept planes in the order of keep plus plane_index, their index in the full set
+    store = PlaneStore(path, mode='w')
+    for start in range(0, len(keep), chunk):
+        index = keep[start:start + chunk]
+        tensors = {name: planes[name][index] for name in plane_names}
+        tensors['plane_index'] = torch.as_tensor(index)
+        if counts is not None:
+            tensors['wins'] = torch.as_tensor(counts[index])
+        store.append(**tensors)
+    if report is not None:
+        store.meta['selection'] = report
+        store.write_meta()
+    return store
+
+
+if __name__ == '__main__':
+    from torchvision import transforms, datasets
+    torch.set_default_tensor_type(torch.FloatTensor)
+    net_file = 'mnist0.5 sigmoid hidden_size[200] test_acc[98.1]'
+    tolerance = 0.1  # % points of validation accuracy the compact set may lose
+    planes = load_planes(net_file)
+    # the planes come from the training set where an image's own plane tends to win, so the test set
+    # is split in two, win counts from the first half and the accuracy check on the second
+    testset = datasets.MNIST('', download=True, train=False, transform=transforms.ToTensor())
+    generator = torch.Generator()
+    generator.manual_seed(272727)
+    split = torch.randperm(len(testset), generator=generator)
+    halves = []
+    for index in [split[:len(testset) // 2], split[len(testset) // 2:]]:
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(testset, index), batch_size=1024, shuffle=False)
+        halves.append([(images.reshape(-1, 784) - 0.5, labels) for images, labels in loader])
+    batches, check_batches = halves
+    keep, counts, report = prune_planes(batches, planes, tolerance, check_batches, memory_budget=2 ** 30)
+    print({name: value for name, value in report.items() if name != 'curve'})
+    # loaded by the scripts with load_planes(net_file + ' pruned')
+    write_planes(planes, keep, store_path(net_file + ' pruned'), counts, report)
+    print("Done")
@@ -0,0 +1,79 @@
+import time
+import numpy as np
+import torch
+
+
+# How well one plane's gradient matrix A_j [in, out] can stand in for another's A_i, measured
+# as the residual |I - pinv(A_i) A_j|^2 (zero when A_j spans the same map as A_i). Pairs are
+# computed a block of rows against a block of columns at a time as one GEMM, and only the k
+# most similar columns of every row are kept, so the [L, L] matrix is never held. planes can
+# be a tensor or a plane store array, blocks are read from it as they are needed.
+
+def pair_residuals(pin_rows, columns):
+    # pin_rows [I, out, in] pseudo inverses, columns [J, in, out] planes, residuals [I, J]
+    rows, num_outputs, inputs = pin_rows.shape
+    product = torch.matmul(pin_rows.reshape(rows * num_outputs, inputs),
+                           columns.permute(1, 0, 2).reshape(inputs, -1))
+    product = product.reshape(rows, num_outputs, len(columns), num_outputs)
+    identity = torch.eye(num_outputs, dtype=product.dtype, device=product.device).reshape(1, num_outputs, 1, -1)
+    return torch.sum(torch.square(identity - product), dim=(1, 3))
+
+
+def top_similar(planes, k=10, block=512, exclude_self=True):
+    # the k smallest residuals of every row and their column indices, each [L, k]
+    num_planes = len(planes)
+    k = min(k, num_planes - 1 if exclude_self else num_planes)
+    top_values = []
+    top_indices = []
+    for row_start in range(0, num_planes, block):
+        row_end = min(row_start + block, num_planes)
+        pin_rows = torch.linalg.pinv(planes[row_start:row_end])
+        best_values = None
+        for column_start in range(0, num_planes, block):
+            column_end = min(column_start + block, num_planes)
+            residuals = pair_residuals(pin_rows, planes[column_start:column_end])
+            columns = torch.arange(column_start, column_end, device=residuals.device)
+            if exclude_self:
+                rows = torch.arange(row_start, row_end, device=residuals.device)
+                residuals = torch.where(rows.unsqueeze(1) == columns, float('inf'), residuals)
+            columns = columns.expand(len(residuals), -1)
+            if best_values is not None:
+                residuals = torch.cat([best_values, residuals], dim=1)
+                columns = torch.cat([best_indices, columns], dim=1)
+            best_values, best = torch.topk(residuals, min(k, residuals.shape[1]), dim=1, largest=False)
+            best_indices = torch.gather(columns, 1, best)
+        top_values.append(best_values)
+        top_indices.append(best_indices)
+    return torch.vstack(top_values), torch.vstack(top_indices)
+
+
+# The per pair loop from inner_product.py, kept to check the blocked version
+def loop_residuals(planes):
+    pin_planes = torch.stack([torch.pinverse(planes[i]) for i in range(len(planes))])
+    corr = []
+    for i in range(len(planes)):
+        corr_row = []
+        for j in range(len(planes)):
+            inv_or_I = torch.matmul(pin_planes[i], planes[j])
+            corr_row.append(torch.sum(torch.square(torch.eye(inv_or_I.shape[0]) - inv_or_I)))
+        corr.append(torch.stack(corr_row))
+    return torch.stack(corr)
+
+
+if __name__ == '__main__':
+    torch.manual_seed(272727)
+    planes = torch.randn(200, 784, 10)
+    # a few near copies so there is something to find
+    planes[100:110] = planes[:10] + 0.01 * torch.randn(10, 784, 10)
+    start = time.perf_counter()
+    looped = loop_residuals(planes)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    values, indices = top_similar(planes, k=5, block=64, exclude_self=False)
+    blocked_time = time.perf_counter() - start
+    loop_values, loop_indices = torch.topk(looped, 5, dim=1, largest=False)
+    print({'loop_time': loop_time,
+           'blocked_time': blocked_time,
+           'speedup': loop_time / blocked_time,
+           'max_difference': torch.max(torch.abs(values - loop_values)).item(),
+           'same_neighbours': float(np.mean((indices == loop_indices).cpu().numpy()))})
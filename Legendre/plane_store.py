@@ -0,0 +1,229 @@
+import os
+import json
+import numpy as np
+import torch
+
+
+# On disk store for extracted Legendre planes. Every tensor (sig_der, sig_c, ...) is a
+# flat binary file of rows that extraction appends to batch by batch, plus a meta.json
+# with the row shape, dtype and the number of rows in each appended chunk. Reading goes
+# through np.memmap so only the rows that are indexed get pulled into memory.
+
+class PlaneArray:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self._memmap = None
+        self._rows = -1
+
+    @property
+    def info(self):
+        return self.store.meta['arrays'][self.name]
+
+    @property
+    def shape(self):
+        return tuple([len(self)] + self.info['row_shape'])
+
+    def __len__(self):
+        return sum(self.info['chunks'])
+
+    def memmap(self):
+        rows = len(self)
+        if self._memmap is None or self._rows != rows:
+            self._memmap = np.memmap(self.store.file_path(self.name), dtype=self.info['dtype'], mode='r',
+                                     shape=tuple([rows] + self.info['row_shape']))
+            self._rows = rows
+        return self._memmap
+
+    def __getitem__(self, index):
+        if isinstance(index, torch.Tensor):
+            index = index.cpu().numpy()
+        values = np.array(self.memmap()[index])
+        return torch.from_numpy(values).to(self.store.device)
+
+    def __iter__(self):
+        for start in range(0, len(self), self.store.read_chunk):
+            for row in self[start:start + self.store.read_chunk]:
+                yield row
+
+
+class PlaneStore:
+    def __init__(self, path, mode='r', device='cpu', read_chunk=1024):
+        self.path = path
+        self.mode = mode
+        self.device = device
+        self.read_chunk = read_chunk
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            self.meta = {'arrays': {}}
+            self.write_meta()
+        else:
+            with open(self.meta_path()) as meta_file:
+                self.meta = json.load(meta_file)
+            if mode == 'a':
+                self.truncate()
+        self.arrays = {name: PlaneArray(self, name) for name in self.meta['arrays']}
+
+    def meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def file_path(self, name):
+        return os.path.join(self.path, '{}.bin'.format(name))
+
+    def write_meta(self):
+        # written to the side then swapped in so a crash never leaves half a meta file
+        temp_path = self.meta_path() + '.tmp'
+        with open(temp_path, 'w') as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(temp_path, self.meta_path())
+
+    def truncate(self):
+        # data is written before meta, so after a crash a file can hold rows meta never recorded
+        for name, info in self.meta['arrays'].items():
+            row_bytes = np.dtype(info['dtype']).itemsize * int(np.prod(info['row_shape']))
+            with open(self.file_path(name), 'ab') as data_file:
+                data_file.truncate(sum(info['chunks']) * row_bytes)
+
+    def append(self, progress=None, **tensors):
+        # progress is any json that should only be saved together with these rows
+        if self.mode == 'r':
+            raise ValueError("plane store {} was opened read only".format(self.path))
+        for name, tensor in tensors.items():
+            values = tensor.detach().cpu().contiguous().numpy()
+            if name not in self.meta['arrays']:
+                self.meta['arrays'][name] = {'row_shape': list(values.shape[1:]),
+                                             'dtype': values.dtype.str,
+                                             'chunks': []}
+                self.arrays[name] = PlaneArray(self, name)
+            info = self.meta['arrays'][name]
+            if list(values.shape[1:]) != info['row_shape']:
+                raise ValueError("{} rows have shape {} but the store holds {}".format(
+                    name, list(values.shape[1:]), info['row_shape']))
+            with open(self.file_path(name), 'ab') as data_file:
+                data_file.write(values.astype(info['dtype'], copy=False).tobytes())
+            info['chunks'].append(int(values.shape[0]))
+        if progress is not None:
+            self.meta['progress'] = progress
+        self.write_meta()
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __len__(self):
+        return min([len(array) for array in self.arrays.values()] or [0])
+
+
+def store_path(net_file, directory='data', suffix=''):
+    # suffix keeps the stores of different extraction variants of one net apart
+    return os.path.join(directory, 'planes {}{}'.format(net_file, suffix))
+
+
+# Opens the plane store for a net, converting the old torch.save files the first time. suffix
+# opens the store of an extraction variant instead, those have no old files to convert.
+def load_planes(net_file, names=('sig_der', 'sig_c', 'cavex_der', 'cavex_c'), device='cpu', directory='data',
+                suffix=''):
+    path = store_path(net_file, directory, suffix)
+    if suffix and not os.path.exists(os.path.join(path, 'meta.json')):
+        raise ValueError("no plane store at {}, run its extraction first".format(path))
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        print("converting saved planes to a plane store")
+        store = PlaneStore(path, mode='w')
+        for name in names:
+            store.append(**{name: torch.load(os.path.join(directory, '{} {}.pt'.format(name, net_file)),
+                                             map_location='cpu')})
+    return PlaneStore(path, device=device)
+
+
+# Extraction over a shuffled loader that can be killed and rerun. The loader's generator state
+# at the start of the pass is saved with the store, a rerun restores it so the loader replays
+# the same batch order and skips the batches already in the store. Planes are buffered and
+# appended every checkpoint_every batches in one meta write together with the batch count.
+# kind names the extraction variant and names the arrays it appends, a store written by another
+# variant or missing any of the arrays is started over rather than resumed or reused.
+class ResumableExtraction:
+    def __init__(self, path, loader, checkpoint_every=50, device='cpu', kind='sig',
+                 names=('sig_der', 'sig_c', 'cavex_der', 'cavex_c')):
+        self.loader = loader
+        self.checkpoint_every = checkpoint_every
+        self.kind = kind
+        self.names = list(names)
+        self.buffer = []
+        if self.resumable(path):
+            self.store = PlaneStore(path, mode='a', device=device)
+        else:
+            self.store = PlaneStore(path, mode='w', device=device)
+        progress = self.store.meta.get('progress')
+        if progress is None:
+            progress = {'batches': 0, 'finished': False, 'generator': self.generator_state().tolist(),
+                        'kind': kind}
+            self.store.meta['progress'] = progress
+            self.store.write_meta()
+        else:
+            self.set_generator_state(torch.tensor(progress['generator'], dtype=torch.uint8))
+            print("resuming extraction after {} batches".format(progress['batches']))
+        self.progress = progress
+
+    def resumable(self, path):
+        # only stores written by a ResumableExtraction of the same kind are resumed
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return False
+        meta = PlaneStore(path).meta
+        if 'progress' not in meta:
+            return False
+        if meta['progress'].get('kind') != self.kind:
+            print("plane store {} holds {} planes not {}, starting over".format(
+                path, meta['progress'].get('kind'), self.kind))
+            return False
+        missing = [name for name in self.names if name not in meta['arrays']]
+        if missing and (meta['arrays'] or meta['progress']['finished']):
+            print("plane store {} is missing {}, starting over".format(path, missing))
+            return False
+        return True
+
+    def generator_state(self):
+        if self.loader.generator is None:
+            return torch.random.get_rng_state()
+        return self.loader.generator.get_state()
+
+    def set_generator_state(self, state):
+        if self.loader.generator is None:
+            torch.random.set_rng_state(state)
+        else:
+            self.loader.generator.set_state(state)
+
+    @property
+    def done(self):
+        return self.progress['batches']
+
+    def batches(self):
+        if self.progress['finished']:
+            return
+        skip = self.done
+        for batch, (images, labels) in enumerate(self.loader):
+            if batch >= skip:
+                yield images, labels
+
+    def append(self, **tensors):
+        self.buffer.append(tensors)
+        if len(self.buffer) >= self.checkpoint_every:
+            self.flush()
+
+    def flush(self, finished=False):
+        progress = dict(self.progress, batches=self.done + len(self.buffer), finished=finished)
+        if self.buffer:
+            self.store.append(progress=progress, **{name: torch.vstack([tensors[name] for tensors in self.buffer])
+                                                    for name in self.buffer[0]})
+        else:
+            self.store.meta['progress'] = progress
+            self.store.write_meta()
+        self.progress = progress
+        self.buffer = []
+
+    def finish(self):
+        self.flush(finished=True)
+        return self.store
@@ -15,6 +15,8 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_store import load_planes
+from Legendre import piecewise_engine
 
 sns.set_theme(style="whitegrid")
 
@@ -69,28 +71,15 @@ def Der(x, w, b, out_w, der_type):
     return out
 
 def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft=False):
-    sy = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(sig_m, sig_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, sm)
-        cavexx = torch.matmul(x, cvm)
-        sy.append(smx + sc)
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    cavexy = torch.stack(cavexy)
-    max_vex_max = torch.max(cavexy, dim=0)[1]
-    # min_cave_min = torch.min(-cavexy, dim=0)[1]
-    vex_sy = torch.stack([torch.stack(
-        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max)])
-    # cave_sy = torch.stack([torch.stack(
-    #     [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min)])
-    # y = (vex_sy + cave_sy) / 2
-    return vex_sy
-
-full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-full_cavex_c = torch.load('data/cavex_c {}.pt'.format(net_file))
-full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-full_cavex_der = torch.load('data/cavex_der {}.pt'.format(net_file))
+    # mindex output, the winning cavex plane picks which sig plane is used
+    return piecewise_engine.piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c)[1]
+
+planes = load_planes(net_file, device=device)
+full_sig_c = planes['sig_c']
+full_cavex_c = planes['cavex_c']
+full_sig_der = planes['sig_der']
+full_cavex_der = planes['cavex_der']
+sweep_budget = 2 ** 30  # bytes of plane responses per chunk of the one pass sweep
 
 with torch.no_grad():
     correct_m = 0
@@ -152,6 +141,39 @@ with torch.no_grad():
                 print(prof.key_averages().table(sort_by="cuda_time_total", row_limit=10))
                 break
 
+    # the accuracy of every sample amount above for the whole test set, one pass over a random
+    # permutation of the planes per repeat
+    test_batches = [(images.reshape(-1, 784).to(torch.device(device)) - 0.5, labels.to(torch.device(device)))
+                    for images, labels in test_loader]
+    sample_amounts = np.linspace(1, number_of_legendre, sample_intervals, dtype=int)
+    print("Profiling the one pass Legendre sweep")
+    with profile(activities=[
+        ProfilerActivity.CPU, ProfilerActivity.CUDA], record_shapes=True) as prof:
+        with record_function("legendre_sweep"):
+            sweep = piecewise_engine.prefix_accuracy_sweep(test_batches, full_sig_der, full_sig_c, full_cavex_der,
+                                                           full_cavex_c, sample_amounts, repeats,
+                                                           memory_budget=sweep_budget)
+
+    print(prof.key_averages().table(sort_by="cpu_time_total", row_limit=10))
+
+    print(prof.key_averages().table(sort_by="cuda_time_total", row_limit=10))
+    for l_amount, amount_sample in zip(sample_amounts, np.transpose(sweep)):
+        print("For amount", l_amount, "mean = {:.2F}    stdev = {:.2F}    min = {:.2F}    max = {:.2F}".format(
+            np.mean(amount_sample),
+            np.std(amount_sample),
+            np.min(amount_sample),
+            np.max(amount_sample)))
+
+    plt.figure()
+    plt.plot(sample_amounts, np.mean(sweep, axis=0), label='mean')
+    plt.fill_between(sample_amounts, np.min(sweep, axis=0), np.max(sweep, axis=0), alpha=0.3, label='min to max')
+    plt.title("Legendre testing accuracy against planes {}".format(net_file))
+    plt.xlabel("Planes")
+    plt.ylabel("Testing accuracy")
+    plt.legend(loc='lower right')
+    plt.savefig("./plots/plane sweep {}.png".format(net_file), bbox_inches='tight', dpi=200, format='png')
+    plt.close()
+
 
 print("Done")
 
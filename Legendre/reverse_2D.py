@@ -14,6 +14,11 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.implicit_planes import AnchorCavexPlanes
+from Legendre.plane_extraction import output_planes
+from Legendre import piecewise_engine
+from Legendre.hessian_bound import hessian_eigenvalues, check_hessian_eigenvalues, lanczos_eigenvalue_bounds, \
+    analytic_hessian_eigenvalues, analytic_eigenvalue_bounds
 
 sns.set_theme(style="whitegrid")
 
@@ -48,40 +53,38 @@ net_file = 'xor sigmoid separate_out hidden_size[8] test_acc[99.53125]'
 model = torch.load('data/'+net_file+'.pt')
 
 num_outputs = 2
+hessian_budget = 2 ** 30  # bytes of Hessians per chunk in calculate_c
+check_hessian = False
+check_extraction = False  # compare output_planes with the per output backward loop
+analytic_c = None  # 'exact' or 'bound' for the closed form Hessians of single hidden layer nets
+lanczos_c = False  # matrix free Lanczos eigenvalue bounds instead of full Hessians, for bigger nets
+lanczos_iterations = 30
+lanczos_safety = 0.05  # relative margin, with the Lanczos residual it takes the place of margin_of_error
 
 def calculate_c(model, all_x):
-    net_hessian = torch.stack([torch.stack([
-        torch.autograd.functional.hessian(model.separate_outputs(out), (all_x[i:i + 1])).squeeze()
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
-
-    eigen_values = torch.stack([torch.stack([
-        torch.linalg.eig(net_hessian[i][out])[0].real
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
+    if lanczos_c:
+        lowest, highest = lanczos_eigenvalue_bounds(model, all_x, lanczos_iterations, safety=lanczos_safety)
+        # kept above 0 so the cavex constant stays positive
+        return torch.max(torch.clamp(torch.maximum(-lowest, highest), min=1e-8), dim=0)[0]
+
+    if analytic_c == 'exact':
+        eigen_values = analytic_hessian_eigenvalues(model, all_x, memory_budget=hessian_budget)
+    elif analytic_c == 'bound':
+        # only the two ends of the spectrum, which is all the reductions below look at
+        eigen_values = torch.stack(analytic_eigenvalue_bounds(model, all_x), dim=2)
+    else:
+        # [B, out, in] eigenvalues, vmapped Hessians and eigvalsh in chunks of hessian_budget bytes
+        eigen_values = hessian_eigenvalues(model, all_x, memory_budget=hessian_budget)
+    if check_hessian and analytic_c != 'bound':
+        check_hessian_eigenvalues(model, all_x, eigen_values)
 
     margin_of_error = 0.90001
 
-    vex_c = torch.stack([torch.stack([
-        torch.max(
-            -torch.min(torch.hstack([
-                eigen_values[i][out], torch.tensor(0)]))) + margin_of_error
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
-
-    cave_c = torch.stack([torch.stack([
-        torch.min(
-            -torch.max(torch.hstack([
-                eigen_values[i][out], torch.tensor(0)]))) + margin_of_error
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
-
-    abs_c = torch.stack([torch.stack([
-        torch.max(
-            torch.abs(torch.hstack([
-                eigen_values[i][out], torch.tensor(0)]))) + margin_of_error
-        for out in range(num_outputs)])
-        for i in range(all_x.shape[0])])
+    vex_c = torch.clamp(-torch.min(eigen_values, dim=2)[0], min=0) + margin_of_error
+
+    cave_c = -torch.clamp(torch.max(eigen_values, dim=2)[0], min=0) + margin_of_error
+
+    abs_c = torch.max(torch.abs(eigen_values), dim=2)[0] + margin_of_error
 
     output_vex = torch.max(vex_c, dim=0)[0]
     output_cave = torch.max(cave_c, dim=0)[0]
@@ -91,58 +94,35 @@ def calculate_c(model, all_x):
     return output_abs
 
 def piecewise_value(x, net_m, net_c, cavex_m, cavex_c, max_mindex=False):
-    sy = []
-    vexy = []
-    cavey = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(net_m, net_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, torch.transpose(sm, 0, 1))
-        vexx = torch.matmul(x, torch.transpose(sm + cvm, 0, 1))
-        cavex = torch.matmul(x, torch.transpose(sm - cvm, 0, 1))
-        cavexx = torch.matmul(x, torch.transpose(cvm, 0, 1))
-        sy.append((smx + sc))
-        vexy.append((vexx + cvc + sc))
-        cavey.append((cavex - cvc + sc))
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    vexy = torch.stack(vexy)
-    cavey = torch.stack(cavey)
-    cavexy = torch.stack(cavexy)
-    y_max = torch.max(vexy, dim=2)[0]
-    y_min = torch.min(cavey, dim=2)[0]
-    max_vex_max3 = torch.max(cavexy, dim=2)
-    min_cave_min3 = torch.min(-cavexy, dim=2)[1]
-    vex_sy = torch.stack([torch.stack(
-        [sy[j][i][output_i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max3[1])])
-    cave_sy = torch.stack([torch.stack(
-        [sy[j][i][output_i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min3)])
+    y, mindex_y = piecewise_engine.piecewise_value(x, net_m, net_c, cavex_m, cavex_c, output_first=True)
     if max_mindex:
-        y = torch.transpose((vex_sy + cave_sy) / 2, 0, 1)
-    else:
-        y = torch.transpose((y_min + y_max) / 2, 0, 1)
+        return mindex_y
     return y
 
-def test_sample(x, net_m, net_c, cavex_m, cavex_c, population):
-    vexy = []
-    cavey = []
-    for sm, sc, cvm, cvc in zip(net_m, net_c, cavex_m, cavex_c):
-        vexx = torch.matmul(x, torch.transpose(sm + cvm, 0, 1))
-        cavex = torch.matmul(x, torch.transpose(sm - cvm, 0, 1))
-        vexy.append((vexx + cvc + sc))
-        cavey.append((cavex - cvc + sc))
-    vexy = torch.stack(vexy)
-    cavey = torch.stack(cavey)
-    all_y = []
-    for agent in population:
-        y_vex = torch.max(vexy[:, :, agent.cpu().numpy()], dim=2)[0]
-        y_cave = torch.min(cavey[:, :, agent.cpu().numpy()], dim=2)[0]
-        all_y.append(torch.transpose((y_vex + y_cave) / 2, 0, 1))
-    return all_y
+def test_sample(x, labels, net_m, net_c, cavex_m, cavex_c, population):
+    if isinstance(cavex_m, AnchorCavexPlanes):
+        sy = torch.stack([torch.matmul(x, torch.transpose(sm, 0, 1)) + sc for sm, sc in zip(net_m, net_c)])
+        cavexy = cavex_m.response(x)
+        vexy = sy + cavexy
+        cavey = sy - cavexy
+    else:
+        vexy = []
+        cavey = []
+        for sm, sc, cvm, cvc in zip(net_m, net_c, cavex_m, cavex_c):
+            vexx = torch.matmul(x, torch.transpose(sm + cvm, 0, 1))
+            cavex = torch.matmul(x, torch.transpose(sm - cvm, 0, 1))
+            vexy.append((vexx + cvc + sc))
+            cavey.append((cavex - cvc + sc))
+        vexy = torch.stack(vexy)
+        cavey = torch.stack(cavey)
+    # correct count of every agent on this batch, [S], left on the device
+    return piecewise_engine.population_correct(vexy.permute(2, 1, 0), cavey.permute(2, 1, 0), population, labels,
+                                               memory_budget=sample_budget)
 
 def reverse_legendre():
     reduced_nm = net_m[:, random_sample[best_agent].cpu().numpy(), :]
     reduced_nc = net_c[:, random_sample[best_agent].cpu().numpy()]
-    reduced_vm = cavex_m[:, random_sample[best_agent].cpu().numpy(), :]
+    reduced_vm = cavex_m[random_sample[best_agent].cpu().numpy()]
     reduced_vc = cavex_c[:, random_sample[best_agent].cpu().numpy()]
 
 
@@ -150,9 +130,7 @@ def reverse_legendre():
 net_out = []
 net_m = []
 net_c = []
-cavex_out = []
-cavex_m = []
-cavex_c = []
+cavex_anchors = []
 
 hidden_size = model.layer[0].bias.shape[0]
 
@@ -185,37 +163,22 @@ print("calculating Legendre planes")
 for images, labels in tqdm(train_loader):
 # for b_i in tqdm(batch_indexes):
 #     images = spanning_data[b_i]
-    images.requires_grad = True
-    n_out = []
-    n_m = []
-    for out in range(num_outputs):
-        n_out.append(model.separate_outputs(out)(images))
-        n_out[-1].backward(torch.ones(images.shape[0]))
-        n_m.append(images.grad.clone().detach())
-        images.grad = None
-        n_out[-1].detach()
-    images.requires_grad = False
+    # every output's plane from one vmapped jacrev instead of a backward per output
+    n_out, n_m, n_c = output_planes(images, model, check=check_extraction)
 
     with torch.no_grad():
         x2_out = torch.sum(images * images, dim=1)
-        cx2 = 0.5 * torch.stack([torch.sum(images * images, dim=1) * c for c in cavex_const])
-        cx2_grad = torch.stack([images * c for c in cavex_const])
-
-        net_out.append(torch.stack(n_out))
-        net_m.append(torch.stack(n_m))
-        net_c.append(torch.stack([
-            n_out[out] - torch.sum(n_m[out] * images, dim=1) for out in range(num_outputs)
-        ]))
-        cavex_out.append(cx2)
-        cavex_m.append(cx2_grad)
-        cavex_c.append(cx2 - torch.sum(cx2_grad * images, dim=2))
+
+        net_out.append(n_out)
+        net_m.append(n_m)
+        net_c.append(n_c)
+        cavex_anchors.append(images.detach())
 
 net_out = torch.hstack(net_out)
 net_m = torch.hstack(net_m)
 net_c = torch.hstack(net_c)
-cavex_out = torch.hstack(cavex_out)
-cavex_m = torch.hstack(cavex_m)
-cavex_c = torch.hstack(cavex_c)
+cavex_m = AnchorCavexPlanes(torch.vstack(cavex_anchors), cavex_const)
+cavex_c = cavex_m.intercepts()
 
 print('', end='')
 
@@ -230,20 +193,19 @@ print('', end='')
 
 sample_size = 10000
 genome_length = 8
+sample_budget = 2 ** 28  # bytes of gathered vex and cave responses per chunk of agents
 random_sample = torch.stack([torch.tensor(
     np.random.choice(range(net_c.shape[1]), genome_length, replace=False)) for i in range(sample_size)])
 correct_m = 0
-correct_l = [0 for i in range(sample_size)]
+correct_l = torch.zeros(sample_size, dtype=torch.long)
 total = 0
 for batch, (images, labels) in enumerate(tqdm(test_loader)):
     out_m = model(images.type(torch.float32))
     _, pred = torch.max(out_m, 1)
     correct_m += (pred == labels).sum().item()
-    out_l = test_sample(images, net_m, net_c, cavex_m, cavex_c, random_sample)
-    for i, out in enumerate(out_l):
-        _, pred = torch.max(out, 1)
-        correct_l[i] += (pred == labels).sum().item()
+    correct_l += test_sample(images, labels, net_m, net_c, cavex_m, cavex_c, random_sample)
     total += labels.size(0)
+correct_l = correct_l.cpu().numpy()
 print('Model testing accuracy: {} %'.format(100 * correct_m / total))
 print("Max = {}   min = {}   average = {}".format(
     np.max(100 * np.array(correct_l) / total),
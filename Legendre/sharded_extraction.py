@@ -0,0 +1,114 @@
+import os
+import shutil
+import multiprocessing
+import torch
+from Legendre.plane_extraction import extract_sig_planes, output_planes
+from Legendre.plane_store import PlaneStore, store_path
+from Legendre.implicit_planes import FactorizedSigPlanes
+
+
+# Plane extraction split over a pool of CPU processes. The samples are cut into contiguous
+# shards on batch boundaries, every worker extracts its shard batch by batch into its own
+# plane store, then the shards are merged in order. Batches are the same as in a single
+# process pass over an unshuffled loader, so the merged store holds the same rows and chunks.
+
+def sig_extractor(images, model):
+    # the split_mnist.py planes plus the hidden derivatives for FactorizedSigPlanes
+    sig_der, sig_c, cavex_der, cavex_c = extract_sig_planes(images, model)
+    return {'sig_der': sig_der, 'sig_c': sig_c, 'cavex_der': cavex_der, 'cavex_c': cavex_c,
+            'hidden_der': FactorizedSigPlanes.from_images(images, model).hidden_der}
+
+
+def output_extractor(images, model):
+    # the hessian_mnist.py planes, stored plane first as net_m [B, out, in] and net_c [B, out]
+    net_out, net_m, net_c = output_planes(images, model)
+    return {'net_m': torch.transpose(net_m, 0, 1), 'net_c': torch.transpose(net_c, 0, 1), 'anchors': images}
+
+
+extractors = {'sig': sig_extractor,
+              'output': output_extractor}
+
+
+def shard_ranges(num_samples, num_shards, batch_size):
+    # contiguous [start, end) ranges cut on batch boundaries
+    num_batches = (num_samples + batch_size - 1) // batch_size
+    per_shard = (num_batches + num_shards - 1) // num_shards
+    ranges = []
+    for shard in range(num_shards):
+        start = shard * per_shard * batch_size
+        end = min((shard + 1) * per_shard * batch_size, num_samples)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+
+def extract_range(dataset, start, end, model, path, batch_size=128, extractor='sig', offset=0.):
+    store = PlaneStore(path, mode='w')
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(start, end)),
+                                         batch_size=batch_size, shuffle=False)
+    with torch.no_grad():
+        for images, labels in loader:
+            images = images.reshape(len(images), -1) + offset
+            store.append(**extractors[extractor](images, model))
+    return path
+
+
+def extract_shard(job):
+    # the job's model was unpickled in this process, keep every default tensor on the cpu
+    torch.set_default_tensor_type(torch.FloatTensor)
+    torch.set_num_threads(job['threads'])
+    return extract_range(job['dataset'], job['start'], job['end'], job['model'], job['path'],
+                         job['batch_size'], job['extractor'], job['offset'])
+
+
+def merge_shards(shard_paths, path, remove=True):
+    merged = PlaneStore(path, mode='w')
+    for shard_path in shard_paths:
+        shard = PlaneStore(shard_path)
+        names = list(shard.meta['arrays'])
+        # one append per original batch keeps the chunk list identical to a single process run
+        rows = 0
+        for size in shard.meta['arrays'][names[0]]['chunks']:
+            merged.append(**{name: shard[name][rows:rows + size] for name in names})
+            rows += size
+        if remove:
+            shutil.rmtree(shard_path)
+    return merged
+
+
+def input_offset(net_file):
+    # the mnist0.5 nets are trained on images - 0.5 and every reader of their planes shifts the same way
+    if net_file.startswith('mnist0.5'):
+        return -0.5
+    return 0.
+
+
+def sharded_extraction(dataset, model, path, num_workers=4, threads=1, batch_size=128, extractor='sig',
+                       offset=0., overwrite=False):
+    if os.path.exists(os.path.join(path, 'meta.json')) and not overwrite:
+        raise ValueError("plane store {} already exists, pass overwrite=True to replace it".format(path))
+    model = model.cpu()
+    ranges = shard_ranges(len(dataset), num_workers, batch_size)
+    jobs = [{'dataset': dataset, 'start': start, 'end': end, 'model': model,
+             'path': '{} shard{}'.format(path, shard), 'threads': threads,
+             'batch_size': batch_size, 'extractor': extractor, 'offset': offset}
+            for shard, (start, end) in enumerate(ranges)]
+    if num_workers == 1:
+        shard_paths = [extract_shard(job) for job in jobs]
+    else:
+        # spawn so the workers do not inherit torch thread pools from the parent
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            shard_paths = pool.map(extract_shard, jobs)
+    return merge_shards(shard_paths, path)
+
+
+if __name__ == '__main__':
+    from torchvision import transforms, datasets
+    net_file = 'mnist0.5 sigmoid hidden_size[200] test_acc[98.1]'
+    model = torch.load('data/'+net_file+'.pt', map_location='cpu')
+    torch.set_default_tensor_type(torch.FloatTensor)
+    trainset = datasets.MNIST('', download=True, train=True, transform=transforms.ToTensor())
+    num_workers = max(1, os.cpu_count() // 2)
+    sharded_extraction(trainset, model, store_path(net_file), num_workers=num_workers, threads=2,
+                       offset=input_offset(net_file))
+    print("Done")
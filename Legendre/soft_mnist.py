@@ -14,6 +14,8 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_store import load_planes
+from Legendre import piecewise_engine
 
 sns.set_theme(style="whitegrid")
 
@@ -68,28 +70,15 @@ def Der(x, w, b, out_w, der_type):
     return out
 
 def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft=True):
-    sy = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(sig_m, sig_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, sm)
-        cavexx = torch.matmul(x, cvm)
-        sy.append(smx + sc)
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    cavexy = torch.stack(cavexy)
     if soft:
-        soft_y = []
-        for level in soft_levels:
-            exp_cavex = torch.exp(cavexy / level)
-            softness = exp_cavex / torch.sum(exp_cavex, dim=0)
-            print(level, torch.min(softness), torch.max(softness))
-            soft_y.append(torch.sum(sy * softness, dim=0))
-        return soft_y
+        # every soft level in one chunked pass, an online softmax so small levels cannot overflow
+        return list(piecewise_engine.soft_piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft_levels,
+                                                          memory_budget=soft_budget))
     else:
+        sy, cavexy = piecewise_engine.plane_responses(x, sig_m, sig_c, cavex_m, cavex_c)
         max_vex_max = torch.max(cavexy, dim=0)[1]
         # min_cave_min = torch.min(-cavexy, dim=0)[1]
-        vex_sy = torch.stack([torch.stack(
-            [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max)])
+        vex_sy = piecewise_engine.gather_planes(sy, max_vex_max)
         # cave_sy = torch.stack([torch.stack(
         #     [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min)])
         # y = (vex_sy + cave_sy) / 2
@@ -152,12 +141,17 @@ def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft=True):
 # torch.save(full_sig_der, 'data/sig_der {}.pt'.format(net_file))
 # torch.save(full_cavex_der, 'data/cavex_der {}.pt'.format(net_file))
 
-full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-full_cavex_c = torch.load('data/cavex_c {}.pt'.format(net_file))
-full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-full_cavex_der = torch.load('data/cavex_der {}.pt'.format(net_file))
+planes = load_planes(net_file, device=device)
+full_sig_c = planes['sig_c']
+full_cavex_c = planes['cavex_c']
+full_sig_der = planes['sig_der']
+full_cavex_der = planes['cavex_der']
+# every batch uses the full plane set so it is read into memory once
+full_sig_c, full_cavex_c, full_sig_der, full_cavex_der = [
+    p[:] for p in [full_sig_c, full_cavex_c, full_sig_der, full_cavex_der]]
 
 soft_levels = [3, 2, 1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1]
+soft_budget = 2 ** 30  # bytes of plane responses and softmax weights per chunk of planes
 
 # with torch.no_grad():
 #     correct_m = 0
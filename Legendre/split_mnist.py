@@ -14,6 +14,9 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_store import load_planes
+from Legendre.implicit_planes import FactorizedSigPlanes
+from Legendre import piecewise_engine
 
 sns.set_theme(style="whitegrid")
 
@@ -68,84 +71,37 @@ def Der(x, w, b, out_w, der_type):
     return out
 
 def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft=False):
-    sy = []
-    cavexy = []
-    for sm, sc, cvm, cvc in zip(sig_m, sig_c, cavex_m, cavex_c):
-        smx = torch.matmul(x, sm)
-        cavexx = torch.matmul(x, cvm)
-        sy.append(smx + sc)
-        cavexy.append(cavexx + cvc)
-    sy = torch.stack(sy)
-    cavexy = torch.stack(cavexy)
-    max_vex_max = torch.max(cavexy, dim=0)[1]
-    min_cave_min = torch.min(-cavexy, dim=0)[1]
-    vex_sy = torch.stack([torch.stack(
-        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(max_vex_max)])
-    cave_sy = torch.stack([torch.stack(
-        [sy[output_i][j][i] for i, output_i in enumerate(idx)]) for j, idx in enumerate(min_cave_min)])
-    y = (vex_sy + cave_sy) / 2
-    return y
-
-# full_sig = []
-# full_cavex = []
-# full_sig_der = []
-# full_cavex_der = []
-# full_sig_c = []
-# full_cavex_c = []
-#
+    # mindex output, FactorizedSigPlanes are handled by the engine
+    return piecewise_engine.piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c)[1]
+
 # legendre_scale_factor = 1#0e3
 #
 # hidden_size = model.layer[0].bias.shape[0]
+# check_extraction = False
+# store = PlaneStore(store_path(net_file), mode='w')
 #
 #
 # print("extracting Legendre transform")
 # for images, labels in tqdm(train_loader):
 #     images = images.reshape(-1, 784).to(torch.device(device))
-#     for i, (w, b, out_w) in enumerate(zip(model.layer[0].weight.data,
-#                                    model.layer[0].bias.data,
-#                                    torch.transpose(model.layer[1].weight.data, 0, 1)
-#                                    )):
-#
-#         neuron_sig = Sig(images, w, b, out_w)
-#         neuron_cavex = CaVexSig(images, w, out_w)
-#         neuron_sig_der = Der(images, w, b, out_w, 'sig')
-#         neuron_cavex_der = Der(images, w, b, out_w, False)
-#
-#         for output, ow in enumerate(out_w):
-#             if ow < 0:
-#                 neuron_cavex[:, output] *= -1
-#                 neuron_cavex_der[:, :, output] *= -1
-#
-#         if not i:
-#             full_sig.append(neuron_sig)
-#             full_cavex.append(neuron_cavex)
-#             full_sig_der.append(neuron_sig_der)
-#             full_cavex_der.append(neuron_cavex_der)
-#         else:
-#             full_sig[-1] += neuron_sig
-#             full_cavex[-1] += neuron_cavex
-#             full_sig_der[-1] += neuron_sig_der
-#             full_cavex_der[-1] += neuron_cavex_der
-#
-#     full_sig_c.append(full_sig[-1] - torch.stack(
-#         [torch.matmul(im, f) for f, im in zip(full_sig_der[-1], images)]))
-#     full_cavex_c.append(full_cavex[-1] - torch.stack(
-#         [torch.matmul(im, f) for f, im in zip(full_cavex_der[-1], images)]))
-#
-# full_sig_c = torch.vstack(full_sig_c)
-# full_cavex_c = torch.vstack(full_cavex_c)
-# full_sig_der = torch.vstack(full_sig_der)
-# full_cavex_der = torch.vstack(full_cavex_der)
-#
-# torch.save(full_sig_c, 'data/sig_c {}.pt'.format(net_file))
-# torch.save(full_cavex_c, 'data/cavex_c {}.pt'.format(net_file))
-# torch.save(full_sig_der, 'data/sig_der {}.pt'.format(net_file))
-# torch.save(full_cavex_der, 'data/cavex_der {}.pt'.format(net_file))
-
-full_sig_c = torch.load('data/sig_c {}.pt'.format(net_file))
-full_cavex_c = torch.load('data/cavex_c {}.pt'.format(net_file))
-full_sig_der = torch.load('data/sig_der {}.pt'.format(net_file))
-full_cavex_der = torch.load('data/cavex_der {}.pt'.format(net_file))
+#     sig_der, sig_c, cavex_der, cavex_c = extract_sig_planes(images, model, check=check_extraction)
+#     hidden_der = FactorizedSigPlanes.from_images(images, model).hidden_der
+#     store.append(sig_der=sig_der, sig_c=sig_c, cavex_der=cavex_der, cavex_c=cavex_c, hidden_der=hidden_der)
+
+planes = load_planes(net_file, device=device)
+full_sig_c = planes['sig_c']
+full_cavex_c = planes['cavex_c']
+full_sig_der = planes['sig_der']
+full_cavex_der = planes['cavex_der']
+
+factorized = False
+if factorized:
+    # ~40x smaller than the dense [L, 784, 10] sig planes
+    if 'hidden_der' in planes:
+        full_sig_der = FactorizedSigPlanes.from_model(model, planes['hidden_der'][:], full_sig_c[:])
+    else:
+        # only works for hidden_size <= 784
+        full_sig_der = FactorizedSigPlanes.from_dense(full_sig_der, full_sig_c, model)
 
 # with torch.no_grad():
 #     correct_m = 0
@@ -14,6 +14,7 @@ import itertools
 from tqdm import tqdm
 from Legendre.train_2D import NeuralNet
 from Legendre.train_2D import generate_corner_2class_data, generate_xor_data
+from Legendre.plane_extraction import extract_sig_planes
 
 sns.set_theme(style="whitegrid")
 
@@ -151,8 +152,6 @@ def piecewise_value(x, sig_m, sig_c, cavex_m, cavex_c, soft=False):
     #     else:
     #         return torch.min(y, dim=0)[0]
 
-full_sig = []
-full_cavex = []
 full_sig_der = []
 full_cavex_der = []
 full_sig_c = []
@@ -161,6 +160,7 @@ full_cavex_c = []
 legendre_scale_factor = 1#0e3
 
 hidden_size = model.layer[0].bias.shape[0]
+check_extraction = False
 
 
 print("extracting Legendre transform")
@@ -179,47 +179,12 @@ batch_indexes = [a_i[j*batch_size:(j+1)*batch_size] for j in range(int(np.ceil(r
 # for images, labels in tqdm(train_loader):
 for b_i in batch_indexes:
     images = spanning_data[batch_indexes]
-    for i, (w, b, out_w) in enumerate(zip(model.layer[0].weight.data,
-                                   model.layer[0].bias.data,
-                                   torch.transpose(model.layer[1].weight.data, 0, 1)
-                                   )):
-
-        w = w.type(default_type)
-        b = b.type(default_type)
-        out_w = out_w.type(default_type)
-
-        # net_values[i].append(Sig(images, w, b, out_w))
-        # vex_values[i].append(CaVexSig(images, w, b, out_w, True))
-        # cave_values[i].append(CaVexSig(images, w, b, out_w, False))
-        neuron_sig = Sig(images, w, b, out_w)
-        neuron_cavex = CaVexSig(images, w, out_w)
-        neuron_sig_der = Der(images, w, b, out_w, 'sig')
-        neuron_cavex_der = Der(images, w, b, out_w, False)
-
-        for output, ow in enumerate(out_w):
-            if ow < 0:
-                # neuron_sig[output] *= -1
-                # neuron_sig_der[output] *= -1
-                neuron_cavex[:, output] *= -1
-                neuron_cavex_der[:, :, output] *= -1
-
-        if not i:
-            full_sig.append(neuron_sig)
-            full_cavex.append(neuron_cavex)
-            full_sig_der.append(neuron_sig_der)
-            full_cavex_der.append(neuron_cavex_der)
-        else:
-            full_sig[-1] += neuron_sig
-            full_cavex[-1] += neuron_cavex
-            full_sig_der[-1] += neuron_sig_der
-            full_cavex_der[-1] += neuron_cavex_der
-
-    # real_net = model(images)
-    full_sig_c.append(full_sig[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(full_sig_der[-1], images)]))
-    full_cavex_c.append(full_cavex[-1] - torch.stack(
-        [torch.matmul(im, f) for f, im in zip(full_cavex_der[-1], images)]))
-    print('', end='')
+    sig_der, sig_c, cavex_der, cavex_c = extract_sig_planes(images.type(default_type), model,
+                                                            check=check_extraction)
+    full_sig_der.append(sig_der)
+    full_sig_c.append(sig_c)
+    full_cavex_der.append(cavex_der)
+    full_cavex_c.append(cavex_c)
 
 full_sig_c = torch.vstack(full_sig_c)
 full_cavex_c = torch.vstack(full_cavex_c)
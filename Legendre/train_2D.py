@@ -8,14 +8,6 @@ from torchvision import transforms, datasets
 import copy
 import matplotlib.pyplot as plt
 
-gpu = True
-if gpu:
-    torch.set_default_tensor_type(torch.cuda.FloatTensor)
-    device = 'cuda'
-else:
-    torch.set_default_tensor_type(torch.FloatTensor)
-    device = 'cpu'
-
 class MyDropout(nn.Module):
     def __init__(self, p: float = 0.5):
         super(MyDropout, self).__init__()
@@ -174,6 +166,13 @@ def generate_corner_2class_data(batch_size=32, batches=40):
 
 
 if __name__ == '__main__':
+    gpu = torch.cuda.is_available()
+    if gpu:
+        torch.set_default_tensor_type(torch.cuda.FloatTensor)
+        device = 'cuda'
+    else:
+        torch.set_default_tensor_type(torch.FloatTensor)
+        device = 'cpu'
 
     torch.manual_seed(272727)
 
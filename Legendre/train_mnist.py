@@ -8,14 +8,6 @@ from torchvision import transforms, datasets
 import copy
 import matplotlib.pyplot as plt
 
-gpu = True
-if gpu:
-    torch.set_default_tensor_type(torch.cuda.FloatTensor)
-    device = 'cuda'
-else:
-    torch.set_default_tensor_type(torch.FloatTensor)
-    device = 'cpu'
-
 
 class MyDropout(nn.Module):
     def __init__(self, p=0.5):
@@ -143,6 +135,13 @@ def check_memory(where=''):
 
 
 if __name__ == '__main__':
+    gpu = torch.cuda.is_available()
+    if gpu:
+        torch.set_default_tensor_type(torch.cuda.FloatTensor)
+        device = 'cuda'
+    else:
+        torch.set_default_tensor_type(torch.FloatTensor)
+        device = 'cpu'
 
     input_size = 28 * 28
     num_classes = 10